@@ -0,0 +1,72 @@
+"""Size and speed of the history file format against pickle.
+
+Run from the project root:  python -m benchmarks.bench_history_codec
+Histories are synthetic chats of 10, 100 and 1000 turns. "last 10" decodes only
+the last 10 turns, what a reader needs to continue a conversation.
+"""
+
+import pickle
+import timeit
+
+import google.ai.generativelanguage as glm
+
+from helpers import history_codec
+
+TURNS = (10, 100, 1000)
+MESSAGE = (
+    "Could you explain how **context windows** work in chat models, and what "
+    "happens to older messages when a conversation gets long? "
+)
+
+
+def make_history(turns: int) -> list:
+    return [
+        glm.Content(
+            role="user" if i % 2 == 0 else "model",
+            parts=[glm.Part(text=f"{i}: " + MESSAGE * (1 if i % 2 == 0 else 6))],
+        )
+        for i in range(turns)
+    ]
+
+
+def codecs():
+    yield "pickle", pickle.dumps, pickle.loads, None
+    compressions = ["none", "gzip"]
+    if history_codec.zstandard is not None:
+        compressions.append("zstd")
+    for compression in compressions:
+        yield (
+            f"codec/{compression}",
+            lambda history, c=compression: history_codec.dumps(history, c),
+            history_codec.loads,
+            lambda data: history_codec.loads(data, last=10),
+        )
+
+
+def timed(func, *args) -> float:
+    timer = timeit.Timer(lambda: func(*args))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def main():
+    print(
+        f"{'turns':>5} {'format':<12} {'bytes':>9} {'encode':>11} "
+        f"{'decode':>11} {'last 10':>11}"
+    )
+    for turns in TURNS:
+        history = make_history(turns)
+        for name, dumps, loads, load_last in codecs():
+            data = dumps(history)
+            assert list(loads(data)) == history
+            encode = timed(dumps, history)
+            decode = timed(loads, data)
+            last = f"{timed(load_last, data) * 1e3:8.3f} ms" if load_last else "-"
+            print(
+                f"{turns:>5} {name:<12} {len(data):>9} {encode * 1e3:8.3f} ms "
+                f"{decode * 1e3:8.3f} ms {last:>11}"
+            )
+
+
+if __name__ == "__main__":
+    main()
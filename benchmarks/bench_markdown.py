@@ -0,0 +1,86 @@
+"""Cost of formatting a Gemini reply: strip_markdown against render_markdown.
+
+Run from the project root:  python -m benchmarks.bench_markdown
+strip_markdown used to run after Telegram rejected the Markdown of a reply, on
+top of the wasted request. render_markdown runs once for every reply and its
+entities are valid by construction.
+"""
+
+import timeit
+
+from helpers.helpers import strip_markdown
+from helpers.telegram_markdown import render_markdown
+
+ROUNDS = 500
+
+SHORT_REPLY = (
+    "Sure! The **capital of France** is *Paris*. "
+    "It has been the capital since the 10th century."
+)
+
+LIST_REPLY = """## How to make a good cup of tea
+
+1. **Boil fresh water.** Re-boiled water tastes flat.
+2. **Warm the pot** with a little hot water, then pour it out.
+3. Add one teaspoon of leaves per cup, plus *one for the pot*.
+
+* Black tea: 95-100°C, 3-5 minutes
+* Green tea: 70-80°C, 1-3 minutes
+* Herbal tea: 100°C, 5-7 minutes
+
+> Milk first or last is a matter of taste, not chemistry.
+
+Enjoy your tea! ☕
+"""
+
+CODE_REPLY = """Here's a function that reads a CSV file and returns the rows as dicts:
+
+```python
+import csv
+
+def read_rows(path: str) -> list[dict]:
+    with open(path, newline="") as fp:
+        return list(csv.DictReader(fp))  # **kwargs aren't needed here
+```
+
+**Notes:**
+
+* `csv.DictReader` uses the first row as the header.
+* Pass `newline=""` so quoted fields with line breaks are read correctly.
+* For large files iterate over the reader instead of building a `list`.
+
+| Option | Default | Meaning |
+|---|---|---|
+| delimiter | `,` | Field separator |
+| quotechar | `"` | Quote character |
+
+See the [csv module docs](https://docs.python.org/3/library/csv.html) for more.
+"""
+
+MALFORMED_REPLY = (
+    "The file my_data_file_v2.csv has 3 * 4 = 12 columns and a **bold claim "
+    "that never closes, plus an `unterminated code span and snake_case_names.\n"
+) * 4
+
+REPLIES = {
+    "short": SHORT_REPLY,
+    "list": LIST_REPLY,
+    "code": CODE_REPLY,
+    "long": (LIST_REPLY + CODE_REPLY) * 4,
+    "malformed": MALFORMED_REPLY,
+}
+
+
+def main():
+    print(f"{'reply':<10} {'chars':>6} {'strip_markdown':>16} {'render_markdown':>16}")
+    for name, reply in REPLIES.items():
+        strip = timeit.timeit(lambda: strip_markdown(reply), number=ROUNDS)
+        render = timeit.timeit(lambda: render_markdown(reply), number=ROUNDS)
+        print(
+            f"{name:<10} {len(reply):>6} "
+            f"{strip / ROUNDS * 1e6:>13.1f} us {render / ROUNDS * 1e6:>13.1f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
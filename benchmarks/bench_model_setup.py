@@ -0,0 +1,49 @@
+"""Per-message setup cost of GeminiChat before and after the model registry.
+
+Run from the project root:  python -m benchmarks.bench_model_setup
+Nothing is sent to Gemini, only the local setup work is measured.
+"""
+
+import json
+import logging
+import timeit
+
+import google.generativeai as genai
+
+from core import GeminiChat, ModelRegistry, SAFETY_SETTINGS_PATH
+
+API_KEY = "benchmark-key"
+ROUNDS = 2000
+
+
+def setup_per_message():
+    """What every message paid before: configure, read settings, build a model."""
+    genai.configure(api_key=API_KEY)
+    with open(SAFETY_SETTINGS_PATH, "r") as fp:
+        safety_settings = json.load(fp)
+    return genai.GenerativeModel("gemini-pro", safety_settings=safety_settings)
+
+
+def setup_with_registry(registry):
+    registry.configure(API_KEY)
+    return registry.get_model("gemini-pro", API_KEY)
+
+
+def setup_gemini_chat():
+    return GeminiChat(gemini_token=API_KEY)._get_model()
+
+
+def main():
+    logging.disable(logging.INFO)
+    registry = ModelRegistry()
+    results = {
+        "per_message": timeit.timeit(setup_per_message, number=ROUNDS),
+        "registry": timeit.timeit(lambda: setup_with_registry(registry), number=ROUNDS),
+        "gemini_chat": timeit.timeit(setup_gemini_chat, number=ROUNDS),
+    }
+    for name, total in results.items():
+        print(f"{name:<12} {total / ROUNDS * 1e6:10.1f} us/message")
+
+
+if __name__ == "__main__":
+    main()
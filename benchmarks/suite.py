@@ -0,0 +1,276 @@
+"""Benchmark suite for the work the bot does in process for every update.
+
+Run from the project root:  python -m benchmarks.suite [--output results.json]
+Compare with an earlier run:  python -m benchmarks.suite --baseline results.json
+Nothing is sent to Telegram or Gemini. Database queries run against SQLite files
+filled with --rows conversations each (default 10k, 100k and 1M), built in a
+temporary directory. Results are written as JSON with the time per call of
+every case, and with a baseline, cases slower by more than --threshold are
+reported and make the run exit with status 1.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import random
+import timeit
+import sqlite3
+import argparse
+import platform
+import tempfile
+import statistics
+from typing import Callable, Iterator
+
+from core import encode_history
+from database import database
+from helpers import history_codec
+from helpers.helpers import conversations_page_content, strip_markdown
+from helpers.inline_paginator import InlineKeyboardPaginator
+from helpers.telegram_markdown import render_markdown, split_markdown
+from benchmarks.bench_markdown import REPLIES
+from benchmarks.bench_history_codec import TURNS, make_history
+
+ROW_COUNTS = (10_000, 100_000, 1_000_000)
+CONVERSATIONS_PER_USER = 100
+CONVERSATIONS_WITH_MESSAGES = 1000
+MESSAGES_PER_CONVERSATION = 20
+REPEAT = 5
+
+# (name, function timed without arguments)
+Case = tuple[str, Callable[[], object]]
+
+
+def timed(func: Callable[[], object], repeat: int = REPEAT) -> dict:
+    """Seconds per call in the best of repeat runs of ~0.2 s each, the least noisy
+    figure to compare, and in the median run."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    runs = [total / number for total in timer.repeat(repeat=repeat, number=number)]
+    return {"seconds": min(runs), "median": statistics.median(runs), "number": number}
+
+
+def helper_cases() -> Iterator[Case]:
+    page = [
+        {"conversation_id": f"conv{i:06d}", "title": f"Conversation about topic {i}"}
+        for i in range(10)
+    ]
+    yield "helpers/conversations_page_content", lambda: conversations_page_content(page)
+    for page_count in (1, 5, 100, 10_000):
+        current_page = max(1, page_count // 2)
+        yield f"paginator/{page_count}_pages", lambda p=page_count, c=current_page: (
+            InlineKeyboardPaginator(p, current_page=c, data_pattern="PAGE#{page}")
+        ).markup
+
+
+def markdown_cases() -> Iterator[Case]:
+    for name, reply in REPLIES.items():
+        yield f"strip_markdown/{name}", lambda r=reply: strip_markdown(r)
+        yield f"render_markdown/{name}", lambda r=reply: render_markdown(r)
+        yield f"split_markdown/{name}", lambda r=reply: split_markdown(r)
+
+
+def history_cases() -> Iterator[Case]:
+    for turns in TURNS:
+        history = make_history(turns)
+        pickled = pickle.dumps(history)
+        encoded = history_codec.dumps(history)
+        yield f"history/pickle_dump/{turns}", lambda h=history: pickle.dumps(h)
+        yield f"history/pickle_load/{turns}", lambda d=pickled: pickle.loads(d)
+        yield f"history/codec_dump/{turns}", lambda h=history: history_codec.dumps(h)
+        yield f"history/codec_load/{turns}", lambda d=encoded: history_codec.loads(d)
+
+
+def build_database(path: str, rows: int) -> None:
+    """Fills a database with rows conversations of rows // 100 users, and messages
+    and cached responses for some of them."""
+    conn = database.create_connection(path)
+    database.create_table(conn)
+    users = max(1, rows // CONVERSATIONS_PER_USER)
+    conn.executemany(
+        "INSERT INTO conversations(conv_id,user_id,title) VALUES(?,?,?);",
+        (
+            (f"conv{i:08d}", i % users, f"Conversation about topic {i}")
+            for i in range(rows)
+        ),
+    )
+    history = encode_history(make_history(MESSAGES_PER_CONVERSATION))
+    for i in range(0, rows, max(1, rows // CONVERSATIONS_WITH_MESSAGES)):
+        database.insert_messages(conn, f"conv{i:08d}", history, 0)
+    conn.executemany(
+        "INSERT INTO response_cache(key,response,created_at) VALUES(?,?,?);",
+        ((f"key{i}", "cached response " * 20, time.time()) for i in range(10_000)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def database_cases(path: str, rows: int) -> Iterator[Case]:
+    conn = database.create_connection(path)
+    users = max(1, rows // CONVERSATIONS_PER_USER)
+    user_id = users // 2
+    row_ids = [
+        row[0]
+        for row in conn.execute(
+            "SELECT id FROM conversations WHERE user_id=? ORDER BY id;",
+            (user_id,),
+        )
+    ]
+    middle = row_ids[len(row_ids) // 2]
+    conv_id = conn.execute(
+        "SELECT conv_id FROM conversations WHERE user_id=? LIMIT 1;", (user_id,)
+    ).fetchone()[0]
+    conv_with_messages = conn.execute(
+        "SELECT conv_id FROM messages LIMIT 1;"
+    ).fetchone()[0]
+    turns = database.select_messages(conn, conv_with_messages)
+    created = iter(range(sys.maxsize))
+
+    def create_and_delete():
+        new_id = f"bench{next(created)}"
+        database.create_conversation(conn, (new_id, user_id, "Benchmark"))
+        database.delete_conversation_by_id(conn, (user_id, new_id))
+
+    prefix = f"db/{rows}"
+    yield f"{prefix}/get_user_conversation_count", lambda: (
+        database.get_user_conversation_count(conn, user_id)
+    )
+    yield f"{prefix}/select_conversations_by_user/first_page", lambda: (
+        database.select_conversations_by_user(conn, (user_id, 0))
+    )
+    yield f"{prefix}/select_conversations_by_user/last_page", lambda: (
+        database.select_conversations_by_user(
+            conn, (user_id, max(0, len(row_ids) - 10))
+        )
+    )
+    yield f"{prefix}/select_conversations_by_cursor", lambda: (
+        database.select_conversations_by_cursor(conn, (user_id, "<", middle, 0, 10))
+    )
+    yield f"{prefix}/select_conversation_by_id", lambda: (
+        database.select_conversation_by_id(conn, (user_id, conv_id))
+    )
+    yield f"{prefix}/update_conversation_title", lambda: (
+        database.update_conversation_title(conn, ("Renamed", conv_id))
+    )
+    yield f"{prefix}/create_and_delete_conversation", create_and_delete
+    yield f"{prefix}/select_messages", lambda: (
+        database.select_messages(conn, conv_with_messages)
+    )
+    yield f"{prefix}/get_next_message_seq", lambda: (
+        database.get_next_message_seq(conn, conv_with_messages)
+    )
+    yield f"{prefix}/insert_messages", lambda: (
+        database.insert_messages(conn, conv_with_messages, turns[-2:], len(turns) - 2)
+    )
+    yield f"{prefix}/select_cached_response", lambda: (
+        database.select_cached_response(conn, (f"key{random.randrange(10_000)}", 0))
+    )
+    yield f"{prefix}/insert_cached_response", lambda: (
+        database.insert_cached_response(conn, ("key0", "cached response", time.time()))
+    )
+    conn.close()
+
+
+def run_cases(cases: Iterator[Case], pattern, repeat: int, results: dict) -> None:
+    for name, func in cases:
+        if pattern and not pattern.search(name):
+            continue
+        results[name] = timed(func, repeat)
+        print(f"{name:<60} {format_seconds(results[name]['seconds']):>12}")
+
+
+def format_seconds(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Prints the change of every case against the baseline and returns the
+    names of the cases that got slower by more than threshold."""
+    regressions = []
+    print(f"\n{'case':<60} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = result["seconds"] / before["seconds"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:<60} {format_seconds(before['seconds']):>12} "
+            f"{format_seconds(result['seconds']):>12} {change:>+8.1%}{flag}"
+        )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--rows",
+        default=",".join(str(rows) for rows in ROW_COUNTS),
+        help="comma separated conversation counts of the benchmark databases",
+    )
+    parser.add_argument("--filter", help="only run cases whose name matches this regex")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="slowdown against the baseline reported as a regression (default 0.2)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=REPEAT, help="timed runs per case (default 5)"
+    )
+    args = parser.parse_args()
+    pattern = re.compile(args.filter) if args.filter else None
+    row_counts = [int(rows) for rows in args.rows.split(",") if rows]
+
+    results = {}
+    run_cases(helper_cases(), pattern, args.repeat, results)
+    run_cases(markdown_cases(), pattern, args.repeat, results)
+    run_cases(history_cases(), pattern, args.repeat, results)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for rows in row_counts:
+            path = os.path.join(tmp_dir, f"bench_{rows}.db")
+            started = time.perf_counter()
+            build_database(path, rows)
+            print(
+                f"built database of {rows} conversations in "
+                f"{time.perf_counter() - started:.1f} s"
+            )
+            run_cases(database_cases(path, rows), pattern, args.repeat, results)
+
+    report = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sqlite": sqlite3.sqlite_version,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(
+                f"\n{len(regressions)} cases regressed by more than "
+                f"{args.threshold:.0%}"
+            )
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import os
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_user_ids(text: str, source: str) -> set[int]:
+    """Reads comma or newline separated user ids; # starts a comment."""
+    user_ids = set()
+    for line in text.splitlines():
+        for value in line.split("#", 1)[0].split(","):
+            value = value.strip()
+            if not value:
+                continue
+            try:
+                user_ids.add(int(value))
+            except ValueError:
+                logger.warning(f"Ignoring invalid user id {value!r} in {source}")
+    return user_ids
+
+
+class AllowList:
+    """Users allowed to use the bot: the ids in AUTHORIZED_USER, read once, and
+    those in AUTHORIZED_USERS_FILE, read again by reload()."""
+
+    def __init__(self, user_ids: str = "", path: str | None = None) -> None:
+        self.path = path
+        self._static = parse_user_ids(user_ids, "AUTHORIZED_USER")
+        self._user_ids = frozenset(self._static)
+        self.reload()
+
+    def reload(self) -> None:
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r") as fp:
+                from_file = parse_user_ids(fp.read(), self.path)
+        except OSError as e:
+            logger.error(f"Failed to read authorized users, keeping the old list: {e}")
+            return
+        self._user_ids = frozenset(self._static | from_file)
+        logger.info(f"Loaded {len(self._user_ids)} authorized users")
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._user_ids
+
+    def __len__(self) -> int:
+        return len(self._user_ids)
+
+
+allow_list = AllowList(
+    os.getenv("AUTHORIZED_USER", ""), os.getenv("AUTHORIZED_USERS_FILE")
+)
@@ -0,0 +1,121 @@
+import os
+import csv
+import io
+import json
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from core import GeminiChat
+from helpers.scheduler import QueueFullError
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_PROMPTS = int(os.getenv("BATCH_MAX_PROMPTS", "1000"))
+BATCH_PROGRESS_INTERVAL = float(os.getenv("BATCH_PROGRESS_INTERVAL", "2.0"))
+# Seconds a prompt waits before it's queued again when the user's queue is full.
+BATCH_QUEUE_RETRY_DELAY = 1.0
+
+# Users with a batch in progress; each user can run one batch at a time.
+running_batches: set[int] = set()
+
+
+def parse_batch_prompts(data: bytes, file_name: str) -> list[str]:
+    """Reads prompts from an uploaded file, one prompt per line.
+    CSV rows are joined with commas and JSONL lines may be objects with a "prompt" key.
+    """
+    text = data.decode("utf-8", "ignore")
+    extension = os.path.splitext(file_name or "")[1].lower()
+
+    if extension == ".csv":
+        rows = csv.reader(io.StringIO(text))
+        prompts = [
+            ", ".join(cell.strip() for cell in row if cell.strip()) for row in rows
+        ]
+    elif extension in (".jsonl", ".ndjson"):
+        prompts = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            prompt = item.get("prompt", "") if isinstance(item, dict) else str(item)
+            if not isinstance(prompt, str):
+                raise ValueError(f"Prompt on line {number} is not a string")
+            prompts.append(prompt)
+    else:
+        prompts = text.splitlines()
+
+    return [prompt.strip() for prompt in prompts if prompt.strip()]
+
+
+async def _send_prompt(gemini_token: str, prompt: str, user_id: int | None) -> dict:
+    gemini_chat = GeminiChat(
+        gemini_token=gemini_token, chat_history=[], user_id=user_id
+    )
+    try:
+        gemini_chat.start_chat()
+        while True:
+            try:
+                response = await gemini_chat.send_message(prompt)
+                break
+            except QueueFullError:
+                # The user's chat shares the queue; wait for room instead of failing.
+                await asyncio.sleep(BATCH_QUEUE_RETRY_DELAY)
+        return {"prompt": prompt, "response": response}
+    except Exception as e:
+        return {"prompt": prompt, "error": str(e)}
+    finally:
+        gemini_chat.close()
+
+
+async def run_batch(
+    prompts: list[str],
+    gemini_token: str,
+    output_path: str,
+    on_progress: Callable[[int, int], Awaitable[None]] | None = None,
+    concurrency: int = BATCH_CONCURRENCY,
+    user_id: int | None = None,
+) -> int:
+    """Sends every prompt as an independent chat of user_id with at most concurrency
+    requests in flight and writes results to output_path as JSON lines in input order,
+    as soon as all earlier results are ready. Returns the number of failed prompts.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = {}
+    next_index = 0
+    done = 0
+    failed = 0
+    last_progress = time.monotonic()
+
+    async def worker(index: int, prompt: str) -> tuple[int, dict]:
+        async with semaphore:
+            return index, await _send_prompt(gemini_token, prompt, user_id)
+
+    tasks = [asyncio.create_task(worker(i, prompt)) for i, prompt in enumerate(prompts)]
+    try:
+        with open(output_path, "w", encoding="utf-8") as fp:
+            for task in asyncio.as_completed(tasks):
+                index, result = await task
+                done += 1
+                failed += "error" in result
+                pending[index] = result
+
+                while next_index in pending:
+                    result = pending.pop(next_index)
+                    fp.write(json.dumps({"line": next_index + 1, **result}) + "\n")
+                    next_index += 1
+                fp.flush()
+
+                now = time.monotonic()
+                if on_progress and now - last_progress >= BATCH_PROGRESS_INTERVAL:
+                    last_progress = now
+                    await on_progress(done, len(prompts))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    logger.info(f"Batch of {len(prompts)} prompts finished, {failed} failed")
+    return failed
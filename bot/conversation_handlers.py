@@ -1,27 +1,65 @@
-import io
+import asyncio
 import os
+import sys
 import logging
 import uuid
 import math
+import time
 import pickle
+import tempfile
 from functools import wraps
 
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    Message,
+    PhotoSize,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+)
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
-import PIL.Image
 
-from core import GeminiChat
+from core import (
+    CHAT_MODEL,
+    VISION_MODEL,
+    GeminiChat,
+    content_text,
+    encode_history,
+    decode_history,
+    generate_chat_title,
+    title_excerpt,
+)
 from database.database import (
-    create_conversation,
+    update_conversation_title,
+    get_next_message_seq,
+    save_conversation,
+    select_messages,
     get_user_conversation_count,
-    select_conversations_by_user,
+    select_conversations_by_cursor,
     select_conversation_by_id,
     delete_conversation_by_id,
 )
+from database.async_database import AsyncDatabase
 from helpers.inline_paginator import InlineKeyboardPaginator
-from helpers.helpers import conversations_page_content, strip_markdown
+from helpers.cache import HistoryCache, ResponseCache
+from helpers import history_codec
+from helpers.scheduler import QueueFullError
+from helpers.resilience import CircuitOpenError
+from helpers.usage import QuotaExceededError
+from helpers.images import select_photo_size, prepare_image
+from helpers.metrics import registry
+from helpers.helpers import conversations_page_content
+from bot.batch import (
+    BATCH_MAX_PROMPTS,
+    parse_batch_prompts,
+    run_batch,
+    running_batches,
+)
+from bot.streaming import STREAM_RESPONSES, stream_to_message, finalize_message
+from bot.delivery import send_markdown
+from bot.metrics import measured
+from bot.access import allow_list
 from dotenv import load_dotenv
 
 
@@ -34,14 +72,36 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
-CHOOSING, IMAGE_CHOICE, CONVERSATION, CONVERSATION_HISTORY = range(4)
+CHOOSING, IMAGE_CHOICE, CONVERSATION, CONVERSATION_HISTORY, BATCH = range(5)
+
+history_cache = HistoryCache(
+    max_bytes=int(os.getenv("HISTORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+)
+media_groups: dict[str, list[Message]] = {}
+MEDIA_GROUP_WAIT = float(os.getenv("MEDIA_GROUP_WAIT", "1.0"))
+
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 60 * 60))),
+)
+registry.add_stats("history_cache", history_cache.stats, counters=["hits", "misses"])
+registry.add_stats(
+    "response_cache",
+    response_cache.stats,
+    counters=["hits", "persistent_hits", "misses"],
+)
+history_load_duration = registry.histogram(
+    "history_load_duration_seconds",
+    "Time to load a saved conversation history, by where it was found.",
+    ["source"],
+)
 
 
 def restricted(func):
     @wraps(func)
     async def wrapped(update, context, *args, **kwargs):
         user_id = update.effective_user.id
-        if user_id != int(os.getenv("AUTHORIZED_USER")):
+        if user_id not in allow_list:
             logger.info(f"Unauthorized access denied for {user_id}.")
             await update.message.reply_animation(
                 "https://github.com/sudoAlireza/GeminiBot/assets/87416117/beeb0fd2-73c6-4631-baea-2e3e3eeb9319",
@@ -53,6 +113,7 @@ def restricted(func):
     return wrapped
 
 
+@measured
 @restricted
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the conversation with /start command and ask the user for input."""
@@ -79,8 +140,34 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return CHOOSING
 
 
+def placeholder_title(history: list) -> str:
+    """Title shown until the generated one is ready: the start of the first message."""
+    if not history:
+        return "New conversation"
+    words = content_text(history[0]).split()
+    title = " ".join(words[:8])
+    return title if len(words) <= 8 else f"{title}..."
+
+
+async def set_conversation_title(
+    db: AsyncDatabase, conversation_id: str, excerpt: str, user_id: int
+) -> None:
+    """Generates the title of a saved conversation and replaces its placeholder."""
+    try:
+        title = await generate_chat_title(
+            excerpt, os.getenv("GEMINI_API_TOKEN"), user_id
+        )
+    except Exception as e:
+        logger.warning(f"Failed to generate title of {conversation_id}: {e}")
+        return
+    if title:
+        await db.run(update_conversation_title, (title, conversation_id))
+        logger.info(f"conversation {conversation_id} titled")
+
+
+@measured
 @restricted
-async def start_over(update: Update, context: ContextTypes.DEFAULT_TYPE, conn) -> int:
+async def start_over(update: Update, context: ContextTypes.DEFAULT_TYPE, db) -> int:
     """Start the conversation with button and ask the user for input."""
     query = update.callback_query
     await query.answer()
@@ -101,24 +188,40 @@ async def start_over(update: Update, context: ContextTypes.DEFAULT_TYPE, conn) -
         if gemini_chat or conversation_id:
             if "_SAVE" in query.data:
                 conversation_history = gemini_chat.get_chat_history()
-                conversation_title = gemini_chat.get_chat_title()
+                is_new = not conversation_id
 
                 conversation_id = conversation_id or f"conv{uuid.uuid4().hex[:6]}"
-                with open(f"./pickles/{conversation_id}.pickle", "wb") as fp:
-                    pickle.dump(conversation_history, fp)
-
+                saved_turns = await db.run(get_next_message_seq, conversation_id)
                 conv = (
                     conversation_id,
                     user_id,
-                    conversation_title,
+                    placeholder_title(conversation_history),
+                )
+                await db.run(
+                    save_conversation,
+                    conv,
+                    encode_history(conversation_history[saved_turns:]),
+                    saved_turns,
                 )
-                create_conversation(conn, conv)
+                history_cache.invalidate(conversation_id)
                 logger.info(f"conversation {conversation_id} saved in db and closed")
 
+                if is_new and conversation_history:
+                    context.application.create_task(
+                        set_conversation_title(
+                            db,
+                            conversation_id,
+                            title_excerpt(conversation_history),
+                            user_id,
+                        ),
+                        update=update,
+                    )
+
             else:
                 logger.info(f"conversation {conversation_id} closed without saving")
 
-            gemini_chat.close()
+            if gemini_chat:
+                gemini_chat.close()
         else:
             logger.info("No active chat to close")
 
@@ -150,6 +253,7 @@ async def start_over(update: Update, context: ContextTypes.DEFAULT_TYPE, conn) -
     return CHOOSING
 
 
+@measured
 @restricted
 async def start_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Ask the user to start conversation by writing any message."""
@@ -174,9 +278,50 @@ async def start_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return CONVERSATION
 
 
+def load_pickle(path: str):
+    with open(path, "rb") as fp:
+        return pickle.load(fp)
+
+
+async def load_conversation_history(db: AsyncDatabase, conv_id: str) -> list:
+    """Load saved turns of a conversation, falling back to its legacy history file"""
+    history = history_cache.get(conv_id)
+    if history is not None:
+        return history
+
+    started = time.perf_counter()
+    turns = await db.run(select_messages, conv_id)
+    if turns:
+        history = decode_history(turns)
+        source = "database"
+    else:
+        history_path = f"./pickles/{conv_id}{history_codec.FILE_EXTENSION}"
+        pickle_path = f"./pickles/{conv_id}.pickle"
+        if os.path.exists(history_path):
+            history = await asyncio.to_thread(
+                history_codec.load_history_file, history_path
+            )
+            source = "history_file"
+        elif os.path.exists(pickle_path):
+            logger.warning(
+                f"Loading legacy pickle of {conv_id}, convert old conversations with "
+                "python -m tools.migrate_pickles"
+            )
+            history = await asyncio.to_thread(load_pickle, pickle_path)
+            source = "pickle"
+        else:
+            return []
+        turns = encode_history(history)
+    history_load_duration.observe(time.perf_counter() - started, source=source)
+
+    history_cache.put(conv_id, history, sum(len(content) for _, content in turns))
+    return history
+
+
+@measured
 @restricted
 async def reply_and_new_message(
-    update: Update, context: ContextTypes.DEFAULT_TYPE
+    update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase
 ) -> int:
     """Send user message to Gemini core and respond and wait for new message or exit command"""
     query = update.callback_query
@@ -194,23 +339,27 @@ async def reply_and_new_message(
 
     text = update.message.text
     conv_id = context.user_data.get("conversation_id")
-    conversation_history = []
-    if conv_id:
-        with open(f"./pickles/{conv_id}.pickle", "rb") as fp:
-            conversation_history = pickle.load(fp)
 
     gemini_chat = context.user_data.get("gemini_chat")
     if not gemini_chat:
         logger.info("Creating new conversation instance")
+        conversation_history = []
+        if conv_id:
+            conversation_history = await load_conversation_history(db, conv_id)
         gemini_chat = GeminiChat(
             gemini_token=os.getenv("GEMINI_API_TOKEN"),
             chat_history=conversation_history,
+            user_id=update.effective_user.id,
         )
         gemini_chat.start_chat()
 
-    response = gemini_chat.send_message(text).encode("utf-8").decode("utf-8", "ignore")
+    async def show_queue_position(position: int) -> None:
+        await msg.edit_text(
+            text=f"Gemini is busy, your message is number {position} in the queue...",
+            reply_markup=reply_markup,
+        )
 
-    context.user_data["gemini_chat"] = gemini_chat
+    gemini_chat.on_queued = show_queue_position
 
     keyboard = [
         [
@@ -224,32 +373,66 @@ async def reply_and_new_message(
             )
         ],
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    save_markup = InlineKeyboardMarkup(keyboard)
 
-    try:
-        await context.bot.send_message(
-            text=response,
-            parse_mode="Markdown",
-            reply_markup=reply_markup,
-            chat_id=update.message.chat_id,
+    cache_key = None
+    response = None
+    if not gemini_chat.get_chat_history():
+        cache_key = response_cache.make_key(
+            CHAT_MODEL, gemini_chat.safety_settings, text
         )
-        await context.bot.delete_message(chat_id=msg.chat_id, message_id=msg.id)
+        response = await response_cache.get(cache_key)
 
-    except Exception as e:
-        await context.bot.send_message(
-            text=strip_markdown(response),
-            reply_markup=reply_markup,
-            chat_id=update.message.chat_id,
+    try:
+        if response is not None:
+            logger.info("Serving first message of conversation from cache")
+            gemini_chat.record_turn(text, response)
+            cache_key = None
+        elif STREAM_RESPONSES:
+            response = await stream_to_message(
+                msg, gemini_chat.stream_message(text), reply_markup=reply_markup
+            )
+        else:
+            response = await gemini_chat.send_message(text)
+    except (QueueFullError, CircuitOpenError, QuotaExceededError, ValueError) as e:
+        logger.warning("Couldn't get a response from Gemini: %s", e)
+        if isinstance(e, QuotaExceededError):
+            text = str(e)
+        elif isinstance(e, QueueFullError):
+            text = "Too many messages are waiting for Gemini. Please try again in a minute."
+        elif isinstance(e, CircuitOpenError):
+            text = "Google Gemini is unavailable at the moment. Please try again in a minute."
+        else:
+            text = "Couldn't reach out to Google Gemini. Try Again..."
+        context.user_data["gemini_chat"] = gemini_chat
+        await msg.edit_text(text=text, reply_markup=save_markup)
+        return CONVERSATION
+    response = response.encode("utf-8").decode("utf-8", "ignore")
+
+    context.user_data["gemini_chat"] = gemini_chat
+    if cache_key and response:
+        await response_cache.put(cache_key, response)
+
+    if STREAM_RESPONSES:
+        await finalize_message(
+            msg,
+            response or "Couldn't reach out to Google Gemini. Try Again...",
+            reply_markup=save_markup,
         )
-        await context.bot.delete_message(chat_id=msg.chat_id, message_id=msg.id)
-        logging.warning(__name__, e)
+        return CONVERSATION
+
+    await asyncio.gather(
+        send_markdown(context.bot, update.message.chat_id, response, save_markup),
+        context.bot.delete_message(chat_id=msg.chat_id, message_id=msg.id),
+    )
 
     return CONVERSATION
 
 
+@measured
 @restricted
 async def get_conversation_handler(
-    update: Update, context: ContextTypes.DEFAULT_TYPE, conn
+    update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase
 ) -> int:
     """Get conversation from database and ask user if wants new conversation or not"""
 
@@ -258,7 +441,7 @@ async def get_conversation_handler(
     user_details = update.message.from_user.id
     conv_specs = (user_details, query_messsage)
 
-    conversation = select_conversation_by_id(conn, conv_specs)
+    conversation = await db.run(select_conversation_by_id, conv_specs)
 
     message_content = f"Conversation {conversation.get('conv_id')} retrieved and title is: {conversation.get('title')}"
 
@@ -285,9 +468,10 @@ async def get_conversation_handler(
     return CONVERSATION_HISTORY
 
 
+@measured
 @restricted
 async def delete_conversation_handler(
-    update: Update, context: ContextTypes.DEFAULT_TYPE, conn
+    update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase
 ) -> int:
     """Delete conversation if user clicks on Delete button"""
     query = update.callback_query
@@ -298,7 +482,8 @@ async def delete_conversation_handler(
     user_details = query.from_user.id
     conv_specs = (user_details, conversation_id)
 
-    conversation = delete_conversation_by_id(conn, conv_specs)
+    conversation = await db.run(delete_conversation_by_id, conv_specs)
+    history_cache.invalidate(conversation_id)
 
     keyboard = [[InlineKeyboardButton("Back to menu", callback_data="Start_Again")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -313,6 +498,7 @@ async def delete_conversation_handler(
     return CHOOSING
 
 
+@measured
 @restricted
 async def start_image_conversation(
     update: Update, context: ContextTypes.DEFAULT_TYPE
@@ -333,6 +519,85 @@ async def start_image_conversation(
     return IMAGE_CHOICE
 
 
+async def describe_images(
+    context: ContextTypes.DEFAULT_TYPE,
+    messages: list[Message],
+    msg: Message,
+) -> None:
+    """Download photos of messages concurrently, send them to Gemini core in one
+    request and replace the waiting message with the response"""
+    photos = [select_photo_size(message.photo) for message in messages]
+    caption = next((message.caption for message in messages if message.caption), None)
+
+    async def download(photo: PhotoSize) -> bytes:
+        photo_file = await photo.get_file()
+        return bytes(await photo_file.download_as_bytearray())
+
+    gemini_image_chat = GeminiChat(
+        gemini_token=os.getenv("GEMINI_API_TOKEN"),
+        user_id=messages[0].from_user.id,
+    )
+    images_data = []
+
+    try:
+        images_data = await asyncio.gather(*(download(photo) for photo in photos))
+        cache_key = response_cache.make_key(
+            VISION_MODEL,
+            gemini_image_chat.safety_settings,
+            caption,
+            *images_data,
+        )
+        response = await response_cache.get(cache_key)
+        if response is None:
+            gemini_image_chat.image = await asyncio.gather(
+                *(
+                    prepare_image(photo, image_data)
+                    for photo, image_data in zip(photos, images_data)
+                )
+            )
+            response = await gemini_image_chat.send_image(caption)
+            response = response.encode("utf-8").decode("utf-8", "ignore")
+
+            if not response:
+                raise Exception("Empty response from Gemini")
+            await response_cache.put(cache_key, response)
+    except QueueFullError:
+        response = (
+            "Too many requests are waiting for Gemini. Please try again in a minute."
+        )
+    except CircuitOpenError:
+        response = (
+            "Google Gemini is unavailable at the moment. Please try again in a minute."
+        )
+    except QuotaExceededError as e:
+        response = str(e)
+    except Exception as e:
+        logger.warning("Error during image processing: %s", e)
+        response = "Couldn't generate a response. Please try again."
+
+    del images_data
+    gemini_image_chat.image = None
+
+    keyboard = [[InlineKeyboardButton("Back to menu", callback_data="Start_Again")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await asyncio.gather(
+        send_markdown(context.bot, msg.chat_id, response, reply_markup),
+        context.bot.delete_message(chat_id=msg.chat_id, message_id=msg.id),
+    )
+
+
+async def describe_media_group(
+    context: ContextTypes.DEFAULT_TYPE, media_group_id: str, msg: Message
+) -> None:
+    """Wait for the rest of an album and describe all of its photos together"""
+    await asyncio.sleep(MEDIA_GROUP_WAIT)
+    messages = media_groups.pop(media_group_id)
+    logger.info(f"Describing album of {len(messages)} photos")
+    await describe_images(context, messages, msg)
+
+
+@measured
 @restricted
 async def generate_text_from_image(
     update: Update, context: ContextTypes.DEFAULT_TYPE
@@ -341,6 +606,11 @@ async def generate_text_from_image(
     query = update.callback_query
     logger.info("Received callback: generate_text_from_image")
 
+    media_group_id = update.message.media_group_id
+    if media_group_id in media_groups:
+        media_groups[media_group_id].append(update.message)
+        return IMAGE_CHOICE
+
     keyboard = [[InlineKeyboardButton("Back to menu", callback_data="Start_Again")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     msg = await update.message.reply_text(
@@ -349,82 +619,176 @@ async def generate_text_from_image(
         reply_markup=reply_markup,
     )
 
-    photo_file = await update.message.photo[-1].get_file()
-    buf = io.BytesIO()
-    await photo_file.download_to_memory(buf)
-    buf.name = "user_image.jpg"
-    buf.seek(0)
+    if media_group_id:
+        # Photos of an album arrive as separate updates, so collect them for a
+        # moment and let this update finish to not hold back the next ones.
+        media_groups[media_group_id] = [update.message]
+        context.application.create_task(
+            describe_media_group(context, media_group_id, msg), update=update
+        )
+        return IMAGE_CHOICE
 
-    image = PIL.Image.open(buf)
+    await describe_images(context, [update.message], msg)
 
-    gemini_image_chat = GeminiChat(
-        gemini_token=os.getenv("GEMINI_API_TOKEN"), image=image
+    # Like after an album, the user can send the next photo right away.
+    return IMAGE_CHOICE
+
+
+@measured
+@restricted
+async def start_batch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Ask user to upload a file of prompts with /batch command"""
+    logger.info("Received command: /batch")
+
+    keyboard = [[InlineKeyboardButton("Back to menu", callback_data="Start_Again")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    msg = await update.message.reply_text(
+        text="You asked for a batch. OK, Send a .txt, .csv or .jsonl file with one prompt per line!",
+        reply_markup=reply_markup,
     )
+    context.user_data["to_delete_message"] = msg
 
-    try:
-        response = response = (
-            gemini_image_chat.send_image(update.message.caption)
-            .encode("utf-8")
-            .decode("utf-8", "ignore")
-        )
+    return BATCH
 
-        if not response:
-            raise Exception("Empty response from Gemini")
-    except Exception as e:
-        logger.warning("Error during image processing: %s", e)
-        response = "Couldn't generate a response. Please try again."
 
-    buf.close()
-    del photo_file
-    del image
+@measured
+@restricted
+async def generate_batch_from_file(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> int:
+    """Send every line of the uploaded file to Gemini and reply with a results document"""
+    logger.info("Received document: batch")
+    document = update.message.document
 
     keyboard = [[InlineKeyboardButton("Back to menu", callback_data="Start_Again")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    try:
-        await context.bot.send_message(
-            text=response,
-            parse_mode="Markdown",
+    user_id = update.message.from_user.id
+    if user_id in running_batches:
+        await update.message.reply_text(
+            text="Your previous batch is still running. Send this file again once its results arrive.",
             reply_markup=reply_markup,
-            chat_id=update.message.chat_id,
         )
-        await context.bot.delete_message(chat_id=msg.chat_id, message_id=msg.id)
+        return BATCH
 
-    except Exception as e:
-        await context.bot.send_message(
-            text=strip_markdown(response),
+    batch_file = await document.get_file()
+    data = await batch_file.download_as_bytearray()
+    try:
+        prompts = parse_batch_prompts(bytes(data), document.file_name)
+    except ValueError as e:
+        logger.warning("Invalid batch file: %s", e)
+        prompts = []
+
+    if not prompts or len(prompts) > BATCH_MAX_PROMPTS:
+        await update.message.reply_text(
+            text=f"Couldn't read prompts from this file. Send a file with 1 to {BATCH_MAX_PROMPTS} lines.",
             reply_markup=reply_markup,
-            chat_id=update.message.chat_id,
         )
-        await context.bot.delete_message(chat_id=msg.chat_id, message_id=msg.id)
-        logging.warning(__name__, e)
+        return BATCH
+
+    msg = await update.message.reply_text(
+        f"Processing 0/{len(prompts)} prompts...", reply_markup=reply_markup
+    )
+    # A batch can take many minutes, so run it without holding back the user's
+    # next updates.
+    running_batches.add(user_id)
+    context.application.create_task(
+        send_batch_results(context, update.message, prompts, msg, reply_markup),
+        update=update,
+    )
 
     return CHOOSING
 
 
+async def send_batch_results(
+    context: ContextTypes.DEFAULT_TYPE,
+    message: Message,
+    prompts: list[str],
+    msg: Message,
+    reply_markup: InlineKeyboardMarkup,
+) -> None:
+    """Run the prompts of a batch and reply to message with the results document"""
+
+    async def on_progress(done_count: int, total: int) -> None:
+        try:
+            await msg.edit_text(
+                f"Processing {done_count}/{total} prompts...", reply_markup=reply_markup
+            )
+        except Exception as e:
+            logger.warning("Failed to update batch progress: %s", e)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "batch_results.jsonl")
+            failed = await run_batch(
+                prompts,
+                os.getenv("GEMINI_API_TOKEN"),
+                output_path,
+                on_progress,
+                user_id=message.from_user.id,
+            )
+            with open(output_path, "rb") as fp:
+                await message.reply_document(
+                    document=fp,
+                    filename="batch_results.jsonl",
+                    caption=f"{len(prompts) - failed}/{len(prompts)} prompts answered",
+                    reply_markup=reply_markup,
+                )
+    finally:
+        running_batches.discard(message.from_user.id)
+
+    await context.bot.delete_message(chat_id=msg.chat_id, message_id=msg.id)
+
+
+@measured
 @restricted
 async def get_conversation_history(
-    update: Update, context: ContextTypes.DEFAULT_TYPE, conn
+    update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase
 ) -> int:
     """Read conversations history of the user"""
     query = update.callback_query
     await query.answer()
     logger.info("Received callback: PAGE#")
 
-    conversations_count = get_user_conversation_count(conn, query.from_user.id)
+    user_id = query.from_user.id
+    conversations_count = await db.run(get_user_conversation_count, user_id)
     total_pages = math.ceil(float(conversations_count / 10))
 
-    page_number = int(query.data.split("#")[1])
-    offset = (page_number - 1) * 10
+    _, page, *cursor = query.data.split("#")
+    page_number = int(page)
+    cursor = cursor[0] if cursor else ""
 
-    conversations = select_conversations_by_user(conn, (query.from_user.id, offset))
+    if cursor == "$":
+        last_page_size = conversations_count - (total_pages - 1) * 10
+        conversation_page = (user_id, ">", 0, 0, last_page_size)
+    elif cursor:
+        conv_row_id, skip = cursor[1:].split(":")
+        conversation_page = (user_id, cursor[0], int(conv_row_id), int(skip), 10)
+    else:
+        conversation_page = (user_id, "<", sys.maxsize, 0, 10)
+
+    conversations = await db.run(select_conversations_by_cursor, conversation_page)
     if conversations:
         page_content = conversations_page_content(conversations)
     else:
         page_content = "You have not any chat history"
 
+    def page_data(page: int) -> str:
+        if page == 1 or not conversations:
+            return "PAGE#1"
+        if page == page_number:
+            return query.data
+        if page == total_pages:
+            return f"PAGE#{page}#$"
+        if page > page_number:
+            skip = (page - page_number - 1) * 10
+            return f"PAGE#{page}#<{conversations[-1]['id']}:{skip}"
+        skip = (page_number - page - 1) * 10
+        return f"PAGE#{page}#>{conversations[0]['id']}:{skip}"
+
     paginator = InlineKeyboardPaginator(
-        total_pages, current_page=page_number, data_pattern="PAGE#{page}"
+        total_pages, current_page=page_number, data_pattern=page_data
     )
     paginator.add_after(
         InlineKeyboardButton("Back to menu", callback_data="Start_Again")
@@ -440,6 +804,7 @@ async def get_conversation_history(
     return CONVERSATION_HISTORY
 
 
+@measured
 @restricted
 async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """End the conversation."""
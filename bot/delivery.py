@@ -0,0 +1,110 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram import Bot, Message, MessageEntity, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
+
+from helpers.scheduler import TokenBucket
+from helpers.telegram_markdown import split_markdown
+
+
+logger = logging.getLogger(__name__)
+
+CHAT_MESSAGES_PER_MINUTE = float(os.getenv("CHAT_MESSAGES_PER_MINUTE", "60"))
+CHAT_MESSAGES_BURST = float(os.getenv("CHAT_MESSAGES_BURST", "3"))
+
+
+class ChatRateLimiter:
+    """Paces outgoing messages per chat to stay under Telegram's flood limits,
+    allowing short bursts. Buckets of the least recently used chats are dropped."""
+
+    def __init__(
+        self, per_minute: float, burst: float, max_chats: int = 10_000
+    ) -> None:
+        self.per_minute = per_minute
+        self.burst = burst
+        self.max_chats = max_chats
+        self._buckets = OrderedDict()
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.per_minute, self.burst)
+            if len(self._buckets) > self.max_chats:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(chat_id)
+        return bucket
+
+    async def wait(self, chat_id: int) -> None:
+        bucket = self._bucket(chat_id)
+        delay = bucket.wait_time(1)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = bucket.wait_time(1)
+        bucket.consume(1)
+
+
+chat_limiter = ChatRateLimiter(CHAT_MESSAGES_PER_MINUTE, CHAT_MESSAGES_BURST)
+
+
+async def send_chunk(
+    bot: Bot,
+    chat_id: int,
+    text: str,
+    entities: list[MessageEntity] | None = None,
+    reply_markup: InlineKeyboardMarkup | None = None,
+) -> Message:
+    """Sends one message within the chat's rate, waiting out flood control and
+    dropping the entities if Telegram rejects them."""
+    await chat_limiter.wait(chat_id)
+    while True:
+        try:
+            return await bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                entities=entities,
+                reply_markup=reply_markup,
+            )
+        except RetryAfter as e:
+            logger.warning(f"Flood control in chat {chat_id}, waiting {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except BadRequest as e:
+            if not entities:
+                raise
+            logger.warning("Failed to send formatted response: %s", e)
+            entities = None
+
+
+async def send_chunks(
+    bot: Bot,
+    chat_id: int,
+    chunks: list[tuple[str, list[MessageEntity]]],
+    reply_markup: InlineKeyboardMarkup | None = None,
+) -> list[Message]:
+    """Sends chunks in order; only the last one gets reply_markup.
+    Each send waits for the previous one, since concurrent requests may reach the
+    chat out of order."""
+    messages = []
+    for index, (text, entities) in enumerate(chunks):
+        last = index == len(chunks) - 1
+        messages.append(
+            await send_chunk(
+                bot, chat_id, text, entities, reply_markup if last else None
+            )
+        )
+    return messages
+
+
+async def send_markdown(
+    bot: Bot,
+    chat_id: int,
+    text: str,
+    reply_markup: InlineKeyboardMarkup | None = None,
+) -> list[Message]:
+    """Sends a Markdown response rendered as entities, split into as many messages
+    as Telegram's length limit needs."""
+    chunks = split_markdown(text) or [(text, [])]
+    return await send_chunks(bot, chat_id, chunks, reply_markup)
@@ -0,0 +1,108 @@
+import os
+import time
+import logging
+from functools import wraps
+
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+from helpers.metrics import registry, metrics_server
+
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 disables the metrics endpoint.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+handler_duration = registry.histogram(
+    "bot_handler_duration_seconds",
+    "Time spent in a bot handler, including the Gemini and Telegram calls it makes.",
+    ["handler"],
+)
+handler_errors = registry.counter(
+    "bot_handler_errors_total",
+    "Exceptions raised by bot handlers.",
+    ["handler", "error"],
+)
+telegram_duration = registry.histogram(
+    "telegram_request_duration_seconds",
+    "Duration of Telegram Bot API requests.",
+    ["method"],
+)
+telegram_errors = registry.counter(
+    "telegram_request_errors_total",
+    "Failed Telegram Bot API requests, by exception or HTTP status.",
+    ["method", "error"],
+)
+
+_server = None
+
+
+def measured(func):
+    """Records the duration and the exceptions of a handler."""
+
+    @wraps(func)
+    async def wrapped(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            handler_errors.inc(handler=func.__name__, error=type(e).__name__)
+            raise
+        finally:
+            handler_duration.observe(
+                time.perf_counter() - started, handler=func.__name__
+            )
+
+    return wrapped
+
+
+class MeasuredRequest(HTTPXRequest):
+    """HTTPXRequest that records the duration and failures of each Bot API call."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        # File downloads end in the file's path, which would make a label per file.
+        api_method = "file" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            telegram_errors.inc(method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            telegram_duration.observe(time.perf_counter() - started, method=api_method)
+        if code >= 400:
+            telegram_errors.inc(method=api_method, error=str(code))
+        return code, payload
+
+
+def add_application_stats(application: Application) -> None:
+    """Exposes the depth of the update queue and of the update processor."""
+    processor = application.update_processor
+
+    def stats() -> dict:
+        values = {"queued": application.update_queue.qsize()}
+        if hasattr(application.update_queue, "unfinished"):
+            values["unfinished"] = application.update_queue.unfinished
+        if hasattr(processor, "stats"):
+            values.update(processor.stats())
+        return values
+
+    registry.add_stats("bot_updates", stats)
+
+
+async def start_metrics_server(application: Application) -> None:
+    global _server
+    add_application_stats(application)
+    if not METRICS_PORT or _server is not None:
+        return
+    _server = metrics_server(METRICS_HOST, METRICS_PORT)
+    await _server.start()
+
+
+async def stop_metrics_server(application: Application) -> None:
+    global _server
+    if _server is not None:
+        await _server.stop()
+        _server = None
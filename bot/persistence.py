@@ -0,0 +1,297 @@
+import os
+import json
+import asyncio
+import logging
+
+from telegram import Message
+from telegram.ext import BasePersistence, PersistenceInput
+
+from core import GeminiChat, encode_history, decode_history
+from database.async_database import AsyncDatabase
+from database.database import (
+    create_persistence_tables,
+    select_persisted_user_data,
+    select_persisted_conversation_states,
+    select_persisted_history,
+    save_persistence_batch,
+)
+from helpers import history_codec
+from bot.sharding import shard_of
+
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "10"))
+# Gives the other updates of a persistence run the time to join the same batch.
+FLUSH_DELAY = 0.5
+
+
+def user_data_fingerprint(data: dict) -> tuple:
+    """Cheap summary of user data that changes whenever its persisted form does.
+    Chat histories only grow, so their length stands in for their content."""
+    fingerprint = []
+    for key, value in sorted(data.items()):
+        if isinstance(value, GeminiChat):
+            value = (
+                value.chat_uuid,
+                len(value.chat_history),
+                value.context_window.summarized_turns,
+            )
+        elif isinstance(value, Message):
+            value = (value.chat_id, value.message_id)
+        fingerprint.append((key, repr(value)))
+    return tuple(fingerprint)
+
+
+def dump_user_data(data: dict) -> str:
+    """Serializes user data to JSON; chat histories are stored separately.
+    Values that can't be stored are left out."""
+    values = {}
+    for key, value in data.items():
+        if isinstance(value, GeminiChat):
+            values[key] = {"type": "gemini_chat", "state": value.to_state()}
+        elif isinstance(value, Message):
+            values[key] = {"type": "message", "message": value.to_dict()}
+        else:
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                logger.warning(
+                    f"Not persisting user data {key!r} of type {type(value)}"
+                )
+                continue
+            values[key] = {"type": "json", "value": value}
+    return json.dumps(values, separators=(",", ":"))
+
+
+class SQLitePersistence(BasePersistence):
+    """Keeps user data and conversation states in the bot's SQLite database.
+
+    Application hands over the users that got updates every update_interval
+    seconds. Only users whose data actually changed are queued, and each run's
+    changes are serialized and written in one transaction on the database's
+    worker threads. Live objects are stored as state they can be rebuilt from:
+    a GeminiChat as its history and context summary, a Message as its JSON.
+    Chat histories only grow, so only the turns added since the last write are
+    appended; a history is rewritten when its chat was replaced or cleared.
+    With shard=(index, count) only the users of that worker process are loaded.
+    """
+
+    def __init__(
+        self,
+        db: AsyncDatabase,
+        update_interval: float = PERSISTENCE_INTERVAL,
+        gemini_token: str | None = None,
+        shard: tuple[int, int] | None = None,
+    ) -> None:
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False
+            ),
+            update_interval=update_interval,
+        )
+        self.db = db
+        self.gemini_token = gemini_token
+        self.shard = shard
+        self._written = {}
+        # user id -> {key: (chat_uuid, number of its turns written)}
+        self._histories = {}
+        self._dirty_users = {}
+        self._dropped_users = set()
+        self._dirty_states = {}
+        self._flush_task = None
+        self._tables_created = False
+
+    def _owns(self, user_id: int) -> bool:
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        return shard_of(user_id, count) == index
+
+    async def _create_tables(self) -> None:
+        if not self._tables_created:
+            await self.db.run(create_persistence_tables)
+            self._tables_created = True
+
+    def _load_value(self, value: dict, history: list):
+        if value["type"] == "gemini_chat":
+            return GeminiChat.from_state(
+                self.gemini_token or os.getenv("GEMINI_API_TOKEN"),
+                value["state"],
+                history,
+            )
+        if value["type"] == "message":
+            return Message.de_json(value["message"], self.bot)
+        return value["value"]
+
+    async def get_user_data(self) -> dict[int, dict]:
+        await self._create_tables()
+        histories = {}
+        for user_id, key, role, content in await self.db.run(select_persisted_history):
+            if self._owns(user_id):
+                histories.setdefault((user_id, key), []).append((role, content))
+
+        user_data = {}
+        for user_id, data, history in await self.db.run(select_persisted_user_data):
+            if not self._owns(user_id):
+                continue
+            try:
+                values = {}
+                for key, value in json.loads(data).items():
+                    turns = histories.get((user_id, key))
+                    if turns is not None:
+                        chat_history = decode_history(turns)
+                    else:
+                        # Written before histories had their own table.
+                        chat_history = history_codec.loads(history) if history else []
+                    values[key] = self._load_value(value, chat_history)
+                    if isinstance(values[key], GeminiChat) and turns is not None:
+                        self._histories.setdefault(user_id, {})[key] = (
+                            values[key].chat_uuid,
+                            len(turns),
+                        )
+            except Exception as e:
+                logger.warning(f"Dropping unreadable persisted data of {user_id}: {e}")
+                self._histories.pop(user_id, None)
+                continue
+            user_data[user_id] = values
+            self._written[user_id] = user_data_fingerprint(values)
+        logger.info(f"Loaded persisted data of {len(user_data)} users")
+        return user_data
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        await self._create_tables()
+        rows = await self.db.run(select_persisted_conversation_states, name)
+        states = {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+        # Conversation keys are (chat_id, user_id).
+        return {key: state for key, state in states.items() if self._owns(key[-1])}
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(FLUSH_DELAY)
+        await self._write()
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        self._dirty_states[(name, json.dumps(key))] = (
+            None if new_state is None else json.dumps(new_state)
+        )
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        fingerprint = user_data_fingerprint(data)
+        if self._written.get(user_id) == fingerprint:
+            return
+        self._written[user_id] = fingerprint
+        self._dropped_users.discard(user_id)
+        self._dirty_users[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._written.pop(user_id, None)
+        self._histories.pop(user_id, None)
+        self._dirty_users.pop(user_id, None)
+        self._dropped_users.add(user_id)
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def _write(self) -> None:
+        users, self._dirty_users = self._dirty_users, {}
+        dropped, self._dropped_users = self._dropped_users, set()
+        states, self._dirty_states = self._dirty_states, {}
+        if not (users or dropped or states):
+            return
+        resets, new_turns = self._history_changes(users)
+
+        def write_batch(conn):
+            # Runs on a worker thread, so serializing doesn't block the loop.
+            user_rows = [
+                (user_id, dump_user_data(data), None) for user_id, data in users.items()
+            ]
+            state_rows = [(name, key, state) for (name, key), state in states.items()]
+            history_rows = [
+                (user_id, key, seq, role, content)
+                for user_id, key, start, turns in new_turns
+                for seq, (role, content) in enumerate(encode_history(turns), start)
+            ]
+            save_persistence_batch(
+                conn, user_rows, list(dropped), state_rows, resets, history_rows
+            )
+
+        try:
+            await self.db.run(write_batch)
+            logger.debug(
+                f"Persisted {len(users)} users, {len(dropped)} dropped, "
+                f"{len(states)} conversation states"
+            )
+        except Exception as e:
+            logger.error(f"Failed to persist bot state: {e}")
+            # Keep the changes for the next run unless newer ones replaced them.
+            for user_id, data in users.items():
+                self._dirty_users.setdefault(user_id, data)
+                self._written.pop(user_id, None)
+                # Unknown what was written, so the histories are written anew.
+                self._histories.pop(user_id, None)
+            self._dropped_users |= dropped - self._dirty_users.keys()
+            for key, state in states.items():
+                self._dirty_states.setdefault(key, state)
+
+    def _history_changes(self, users: dict) -> tuple[list, list]:
+        """The (user_id, key) histories to delete and the (user_id, key, first seq,
+        turns) to append so the stored histories match the chats in users."""
+        resets = []
+        new_turns = []
+        for user_id, data in users.items():
+            written = self._histories.get(user_id, {})
+            current = {}
+            for key, value in data.items():
+                if not isinstance(value, GeminiChat):
+                    continue
+                history = value.chat_history
+                # PTB hands over deep copies, so chats are told apart by chat_uuid.
+                chat_uuid, count = written.get(key, (None, None))
+                if chat_uuid != value.chat_uuid or count > len(history):
+                    resets.append((user_id, key))
+                    count = 0
+                if count < len(history):
+                    new_turns.append((user_id, key, count, history[count:]))
+                current[key] = (value.chat_uuid, len(history))
+            resets.extend((user_id, key) for key in written.keys() - current.keys())
+            self._histories[user_id] = current
+        return resets, new_turns
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write()
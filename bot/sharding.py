@@ -0,0 +1,160 @@
+"""Multi-process mode: one intake process receives updates and hands each one to
+the worker process that owns its user.
+
+A user always maps to the same worker, so the worker's ConversationHandler,
+user data and caches see all of that user's updates, in order. Workers share
+only the database. Each worker gets an equal share of the Gemini quota.
+"""
+
+import os
+import json
+import math
+import signal
+import asyncio
+import logging
+import multiprocessing
+
+from telegram import Update
+from telegram.ext import ContextTypes, TypeHandler
+
+
+logger = logging.getLogger(__name__)
+
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+# Limits that are per process and have to be split between the workers.
+SHARED_LIMITS = {
+    "GEMINI_RPM": "60",
+    "GEMINI_TPM": "0",
+    "GEMINI_MAX_CONCURRENCY": "16",
+    "GEMINI_MAX_QUEUE": "256",
+}
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    return user_id % shards
+
+
+def worker_environment(index: int, shards: int) -> dict[str, str]:
+    """Environment of a worker: its share of the process-wide limits and, next to
+    the intake's metrics endpoint, a metrics port of its own."""
+    environment = {}
+    for name, default in SHARED_LIMITS.items():
+        value = float(os.getenv(name, default)) / shards
+        environment[name] = str(max(1, math.ceil(value)) if value > 0 else 0)
+    if int(os.getenv("METRICS_PORT", "0")):
+        environment["METRICS_PORT"] = str(int(os.getenv("METRICS_PORT")) + index + 1)
+    return environment
+
+
+def worker_main(
+    index: int, shards: int, queue: multiprocessing.Queue, db_file: str
+) -> None:
+    """Entry point of a worker process."""
+    # The intake process handles Ctrl+C and stops the workers through their queues.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, shards, queue, db_file))
+
+
+async def _run_worker(
+    index: int, shards: int, queue: multiprocessing.Queue, db_file: str
+) -> None:
+    import main
+    from database.async_database import AsyncDatabase
+
+    main.model_registry.reload_safety_settings()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: main.reload_settings())
+
+    main.db = AsyncDatabase(db_file, max_workers=int(os.getenv("DB_WORKERS", "2")))
+    application = main.build_application(shard=(index, shards))
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info(f"Worker {index + 1}/{shards} started")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            update = Update.de_json(json.loads(data), application.bot)
+            await application.update_queue.put(update)
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        logger.info(f"Worker {index + 1}/{shards} stopped")
+
+
+class ShardedWorkers:
+    """Starts the worker processes and forwards updates to them by user id."""
+
+    def __init__(self, shards: int, db_file: str) -> None:
+        self.shards = shards
+        self.db_file = db_file
+        self.forwarded = [0] * shards
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue(WORKER_QUEUE_SIZE) for _ in range(shards)]
+        self.processes = [
+            context.Process(
+                target=worker_main,
+                args=(index, shards, self.queues[index], db_file),
+                name=f"worker-{index}",
+            )
+            for index in range(shards)
+        ]
+
+    def start(self) -> None:
+        # A spawned process gets the environment of this one at start() and imports
+        # main, and with it core, before worker_main runs. So the worker's settings
+        # have to be in the environment it starts with.
+        for index, process in enumerate(self.processes):
+            environment = worker_environment(index, self.shards)
+            saved = {name: os.environ.get(name) for name in environment}
+            os.environ.update(environment)
+            try:
+                process.start()
+            finally:
+                for name, value in saved.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+        logger.info(f"Started {self.shards} worker processes")
+
+    def stop(self, timeout: float = 30) -> None:
+        """Lets every worker finish its queued updates and waits for it to exit."""
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} didn't stop in time, terminating")
+                process.terminate()
+                process.join()
+
+    def stats(self) -> dict:
+        return {"forwarded": {str(i): n for i, n in enumerate(self.forwarded)}}
+
+    def send_signal(self, signum: int) -> None:
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    async def forward(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        index = shard_of(user.id if user else 0, self.shards)
+        data = update.to_json()
+        queue = self.queues[index]
+        # put blocks while the worker is behind, keep the event loop free meanwhile.
+        await asyncio.get_running_loop().run_in_executor(None, queue.put, data)
+        self.forwarded[index] += 1
+
+    def handler(self) -> TypeHandler:
+        return TypeHandler(Update, self.forward)
@@ -0,0 +1,76 @@
+import os
+import time
+import logging
+from typing import AsyncIterator
+
+from telegram import Message, InlineKeyboardMarkup
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest
+
+from bot.delivery import send_chunks
+from helpers.telegram_markdown import split_markdown
+
+
+logger = logging.getLogger(__name__)
+
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+
+async def _edit_text(message: Message, text: str, **kwargs) -> None:
+    try:
+        await message.edit_text(text, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+
+async def stream_to_message(
+    message: Message,
+    chunks: AsyncIterator[str],
+    reply_markup: InlineKeyboardMarkup | None = None,
+    edit_interval: float = STREAM_EDIT_INTERVAL,
+) -> str:
+    """Edits message with the text received so far, at most once per edit_interval
+    seconds, and returns the whole text when the stream ends.
+    Intermediate edits are sent as plain text because partial Markdown is often invalid.
+    """
+    text = ""
+    shown = ""
+    last_edit = 0.0
+    async for chunk in chunks:
+        text += chunk
+        now = time.monotonic()
+        if now - last_edit < edit_interval or not text.strip():
+            continue
+
+        preview = text[: MessageLimit.MAX_TEXT_LENGTH]
+        if preview != shown:
+            try:
+                await _edit_text(message, preview, reply_markup=reply_markup)
+                shown = preview
+            except Exception as e:
+                logger.warning("Failed to edit streamed message: %s", e)
+            last_edit = time.monotonic()
+
+    return text
+
+
+async def finalize_message(
+    message: Message, text: str, reply_markup: InlineKeyboardMarkup | None = None
+) -> None:
+    """Replaces message content with the final text with its Markdown rendered as
+    entities. Text over Telegram's length limit continues in new messages, and
+    reply_markup goes to the last one."""
+    chunks = split_markdown(text) or [(text, [])]
+    first_text, entities = chunks[0]
+    first_markup = reply_markup if len(chunks) == 1 else None
+    try:
+        await _edit_text(
+            message, first_text, entities=entities, reply_markup=first_markup
+        )
+    except BadRequest as e:
+        logger.warning("Failed to send formatted response: %s", e)
+        await _edit_text(message, first_text, reply_markup=first_markup)
+
+    await send_chunks(message.get_bot(), message.chat_id, chunks[1:], reply_markup)
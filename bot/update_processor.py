@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue(asyncio.Queue):
+    """Update queue whose maxsize also counts the updates being processed.
+
+    Application takes every update off its queue right away and processes it in
+    a task of its own, so the size of a plain queue stays near zero however many
+    updates are in the bot. An update only counts as done once Application calls
+    task_done after processing it. Until then put waits and put_nowait raises
+    QueueFull when maxsize updates are queued or being processed.
+    """
+
+    def __init__(self, maxsize: int = 0) -> None:
+        super().__init__()
+        self.limit = maxsize
+        self.unfinished = 0
+        self._space = asyncio.Event()
+
+    def full(self) -> bool:
+        return 0 < self.limit <= self.unfinished
+
+    def put_nowait(self, item) -> None:
+        super().put_nowait(item)
+        self.unfinished += 1
+
+    async def put(self, item) -> None:
+        while self.full():
+            self._space.clear()
+            await self._space.wait()
+        self.put_nowait(item)
+
+    def task_done(self) -> None:
+        super().task_done()
+        self.unfinished -= 1
+        self._space.set()
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different users concurrently while keeping the
+    updates of a single user in order, so ConversationHandler states stay consistent.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._waiters: dict[int, int] = {}
+
+    @staticmethod
+    def _get_key(update: object) -> int | None:
+        if isinstance(update, Update) and update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(
+        self, update: object, coroutine: Awaitable[Any]
+    ) -> None:
+        """Awaits the coroutine once previous updates of the same user are processed."""
+        key = self._get_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._locks),
+            "pending": sum(self._waiters.values()),
+        }
+
+    async def initialize(self) -> None:
+        """Nothing to initialize."""
+
+    async def shutdown(self) -> None:
+        """Drops the per-user locks."""
+        self._locks.clear()
+        self._waiters.clear()
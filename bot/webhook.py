@@ -0,0 +1,118 @@
+import hmac
+import json
+import signal
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import Application
+
+from helpers.http_server import HTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+
+
+class WebhookReceiver:
+    """Accepts updates posted by Telegram and puts them into the application's
+    update queue. A full queue answers 429 so Telegram retries the update later
+    instead of the bot buffering without limit."""
+
+    def __init__(
+        self, application: Application, url_path: str, secret_token: str | None
+    ) -> None:
+        self.application = application
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+
+    async def __call__(
+        self, method: str, path: str, headers: dict, body: bytes
+    ) -> tuple[int, str, bytes]:
+        if path != self.url_path:
+            return 404, "text/plain", b""
+        if method != "POST":
+            return 405, "text/plain", b""
+        if self.secret_token and not hmac.compare_digest(
+            headers.get(SECRET_TOKEN_HEADER, ""), self.secret_token
+        ):
+            logger.warning("Rejected webhook request with invalid secret token")
+            return 403, "text/plain", b""
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError) as e:
+            logger.warning("Invalid webhook payload: %s", e)
+            return 400, "text/plain", b""
+
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning("Update queue is full, asking Telegram to retry")
+            return 429, "text/plain", b""
+
+        self.received += 1
+        return 200, "text/plain", b""
+
+
+async def serve_webhook(
+    application: Application,
+    webhook_url: str,
+    listen: str,
+    port: int,
+    url_path: str,
+    secret_token: str | None,
+    allowed_updates: list[str],
+    max_connections: int = 40,
+    stop_event: asyncio.Event | None = None,
+) -> None:
+    """Runs the application behind the embedded webhook server until stop_event
+    is set or the process receives SIGINT/SIGTERM."""
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    server = HTTPServer(
+        WebhookReceiver(application, url_path, secret_token),
+        listen,
+        port,
+        max_connections=max_connections,
+    )
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await server.start()
+        await application.bot.set_webhook(
+            url=webhook_url,
+            allowed_updates=allowed_updates,
+            secret_token=secret_token,
+            max_connections=max_connections,
+        )
+        await application.start()
+        logger.info(f"Receiving updates with webhook on {listen}:{server.port}")
+
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application: Application, **kwargs) -> None:
+    """Blocking counterpart of serve_webhook, like Application.run_polling."""
+    asyncio.run(serve_webhook(application, **kwargs))
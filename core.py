@@ -1,26 +1,401 @@
+import os
+import copy
 import json
+import time
+import uuid
+import asyncio
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 import logging
+from typing import AsyncIterator, Awaitable
+
+from helpers.scheduler import GeminiScheduler, QueueFullError
+from helpers.usage import UsageTracker
+from helpers.metrics import registry
+from helpers.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    LatencyTracker,
+    RetryPolicy,
+)
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+SAFETY_SETTINGS_PATH = "./safety_settings.json"
+CHAT_MODEL = "gemini-pro"
+VISION_MODEL = "gemini-pro-vision"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+# Seconds before folding into the summary is retried after a failure, doubling
+# with every further failure up to SUMMARY_MAX_BACKOFF.
+SUMMARY_BACKOFF = float(os.getenv("SUMMARY_BACKOFF", "60"))
+SUMMARY_MAX_BACKOFF = 3600
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 258
+TITLE_MODEL = os.getenv("TITLE_MODEL", CHAT_MODEL)
+TITLE_EXCERPT_CHARS = int(os.getenv("TITLE_EXCERPT_CHARS", "1500"))
+TITLE_PROMPT = (
+    "Write a one-line short title up to 10 words for this conversation in plain text."
+)
+
+
+class ModelRegistry:
+    """Process-wide cache of generative models keyed by (model name, safety settings,
+    API key), so chats share model objects instead of building them per message.
+    """
+
+    def __init__(self, safety_settings_path: str = SAFETY_SETTINGS_PATH) -> None:
+        self.safety_settings_path = safety_settings_path
+        self._safety_settings = None
+        self._configured_key = None
+        self._models = {}
+
+    @property
+    def safety_settings(self) -> list:
+        if self._safety_settings is None:
+            self.reload_safety_settings()
+        return self._safety_settings
+
+    def reload_safety_settings(self) -> None:
+        """Reads the safety settings file again and drops models built with old settings."""
+        with open(self.safety_settings_path, "r") as fp:
+            self._safety_settings = json.load(fp)
+        self._models.clear()
+        logging.info("Loaded safety settings")
+
+    def configure(self, api_key: str) -> None:
+        """Configures the SDK only when the API key changes."""
+        if api_key != self._configured_key:
+            genai.configure(api_key=api_key)
+            self._configured_key = api_key
+
+    def get_model(
+        self, model_name: str, api_key: str, safety_settings: list | None = None
+    ) -> genai.GenerativeModel:
+        """Returns the shared model for the given parameters, building it on first use."""
+        safety_settings = safety_settings or self.safety_settings
+        key = (
+            model_name,
+            tuple((s["category"], s["threshold"]) for s in safety_settings),
+            api_key,
+        )
+        model = self._models.get(key)
+        if model is None:
+            self.configure(api_key)
+            model = genai.GenerativeModel(model_name, safety_settings=safety_settings)
+            self._models[key] = model
+            logging.info(f"Built generative model {model_name}")
+        return model
+
+
+model_registry = ModelRegistry()
+
+
+def encode_history(history: list) -> list[tuple[str, bytes]]:
+    """Encodes chat history turns as (role, serialized content) tuples for storage."""
+    return [(content.role, glm.Content.serialize(content)) for content in history]
+
+
+def decode_history(turns: list[tuple[str, bytes]]) -> list:
+    """Decodes turns produced by encode_history back into chat history."""
+    return [glm.Content.deserialize(content) for _, content in turns]
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate, good enough for budgeting the context."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def content_text(content) -> str:
+    return "".join(part.text for part in content.parts)
+
+
+def usage_tokens(response, request_tokens: int) -> tuple[int, int]:
+    """Prompt and response tokens of a request, from usage metadata when the SDK
+    reports it and estimated otherwise."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        return usage.prompt_token_count, usage.candidates_token_count
+    return request_tokens, estimate_tokens(response.text)
+
+
+gemini_scheduler = GeminiScheduler(
+    requests_per_minute=float(os.getenv("GEMINI_RPM", "60")),
+    tokens_per_minute=float(os.getenv("GEMINI_TPM", "0")),
+    max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "16")),
+    max_queue_per_user=int(os.getenv("GEMINI_MAX_QUEUE_PER_USER", "16")),
+    max_queue=int(os.getenv("GEMINI_MAX_QUEUE", "256")),
+)
+
+# Per user limits, 0 for none.
+usage_tracker = UsageTracker(
+    daily_requests=int(os.getenv("USER_DAILY_REQUESTS", "0")),
+    daily_tokens=int(os.getenv("USER_DAILY_TOKENS", "0")),
+    monthly_requests=int(os.getenv("USER_MONTHLY_REQUESTS", "0")),
+    monthly_tokens=int(os.getenv("USER_MONTHLY_TOKENS", "0")),
+    flush_interval=float(os.getenv("USAGE_FLUSH_INTERVAL", "10")),
+)
+
+gemini_retry_policy = RetryPolicy(
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("GEMINI_BREAKER_FAILURES", "5")),
+        reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+    ),
+    max_attempts=int(os.getenv("GEMINI_MAX_ATTEMPTS", "3")),
+    base_delay=float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5")),
+    max_delay=float(os.getenv("GEMINI_RETRY_MAX_DELAY", "8")),
+    timeout=float(os.getenv("GEMINI_REQUEST_TIMEOUT", "120")),
+    hedge=os.getenv("GEMINI_HEDGE", "false").lower() in ("1", "true", "yes"),
+)
+# Summaries run in the background and have a breaker of their own, so their
+# failures don't block the requests users wait for.
+summary_retry_policy = RetryPolicy(
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("GEMINI_BREAKER_FAILURES", "5")),
+        reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+    ),
+    max_attempts=int(os.getenv("GEMINI_MAX_ATTEMPTS", "3")),
+    base_delay=float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5")),
+    max_delay=float(os.getenv("GEMINI_RETRY_MAX_DELAY", "8")),
+    timeout=float(os.getenv("GEMINI_REQUEST_TIMEOUT", "120")),
+)
+chat_latency = LatencyTracker()
+vision_latency = LatencyTracker()
+
+gemini_ttft = registry.histogram(
+    "gemini_time_to_first_token_seconds",
+    "Time from sending a Gemini request to its first response chunk.",
+    ["operation"],
+)
+gemini_duration = registry.histogram(
+    "gemini_request_duration_seconds",
+    "Time from sending a Gemini request to its complete response.",
+    ["operation"],
+)
+gemini_tokens = registry.counter(
+    "gemini_tokens_total",
+    "Tokens of Gemini requests, estimated when the SDK reports no usage.",
+    ["operation", "kind"],
+)
+registry.add_stats("gemini_scheduler", gemini_scheduler.stats, counters=["rejected"])
+registry.add_stats("gemini_usage", usage_tracker.stats, counters=["rejected"])
+registry.add_stats(
+    "gemini",
+    gemini_retry_policy.stats,
+    counters=["retries", "hedges", "hedge_wins", "errors"],
+)
+registry.add_stats(
+    "gemini_summary",
+    summary_retry_policy.stats,
+    counters=["retries", "hedges", "hedge_wins", "errors"],
+)
+
+
+def record_usage(request, response, request_tokens: int, operation: str) -> None:
+    """Counts the tokens of a finished request and charges them to the scheduler
+    and to the user's usage."""
+    prompt, candidates = usage_tokens(response, request_tokens)
+    gemini_tokens.inc(prompt, operation=operation, kind="prompt")
+    gemini_tokens.inc(candidates, operation=operation, kind="response")
+    gemini_scheduler.record_usage(request, prompt + candidates)
+    usage_tracker.record(request.user_id, prompt, candidates)
+
+
+async def resolve_response(
+    request: Awaitable, operation: str, timeout: float | None = None
+):
+    """Awaits a streamed generate request and the rest of its chunks within timeout."""
+
+    async def resolve():
+        started = time.perf_counter()
+        response = await request
+        gemini_ttft.observe(time.perf_counter() - started, operation=operation)
+        await response.resolve()
+        gemini_duration.observe(time.perf_counter() - started, operation=operation)
+        return response
+
+    return await asyncio.wait_for(resolve(), timeout)
+
+
+def title_excerpt(history: list, max_chars: int = TITLE_EXCERPT_CHARS) -> str:
+    """The beginning of a conversation as text, at most max_chars long; long
+    messages are shortened so more than the first one fits."""
+    lines = []
+    remaining = max_chars
+    for content in history:
+        if remaining <= 0:
+            break
+        text = content_text(content)[: max(max_chars // 4, remaining // 2)]
+        line = f"{content.role}: {text}"[:remaining]
+        lines.append(line)
+        remaining -= len(line) + 1
+    return "\n".join(lines)
+
+
+async def generate_chat_title(excerpt: str, api_key: str, user_id=None) -> str:
+    """Asks the title model for a short title of a conversation excerpt, without
+    touching any chat session."""
+    prompt = f"{TITLE_PROMPT}\n\n{excerpt}"
+    request_tokens = estimate_tokens(prompt)
+    usage_tracker.check(user_id, request_tokens)
+
+    async def generate():
+        async with gemini_scheduler.slot(user_id, request_tokens) as request:
+            model = model_registry.get_model(TITLE_MODEL, api_key)
+            with gemini_duration.time(operation="title"):
+                response = await asyncio.wait_for(
+                    model.generate_content_async(
+                        prompt,
+                        generation_config={"max_output_tokens": 32, "temperature": 0.2},
+                    ),
+                    gemini_retry_policy.timeout,
+                )
+            record_usage(request, response, request_tokens, "title")
+        return response
+
+    response = await gemini_retry_policy.call(generate, "get chat title")
+    return response.text.strip().strip("*#\"' ")
+
+
+class ContextWindow:
+    """Keeps the recent turns of a chat verbatim within a token budget and folds
+    older turns into a running summary.
+
+    When the history outgrows the budget, turns are folded until the verbatim part
+    fits in half of the budget, so the summary is updated once every several turns
+    and only with the newly folded turns. Folding runs after a reply rather than
+    before the next message, and is retried with backoff when it fails; until then
+    the turns that should have been folded are sent verbatim.
+    """
+
+    SUMMARY_PROMPT = (
+        "Update the summary of a conversation between a user and an assistant. "
+        "Keep facts, decisions, names and open questions, and write at most 200 words "
+        "in plain text.\n\nCurrent summary:\n{summary}\n\nNew messages:\n{messages}"
+    )
+
+    def __init__(
+        self,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+        summary_model: str = "gemini-pro",
+    ) -> None:
+        self.token_budget = token_budget
+        self.summary_model = summary_model
+        self.summary = ""
+        self.summarized_turns = 0
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def _window_start(self, history: list, token_budget: int) -> int:
+        """Index of the first turn that fits in token_budget counting from the end."""
+        tokens = estimate_tokens(self.summary)
+        start = len(history)
+        while start > self.summarized_turns:
+            tokens += estimate_tokens(content_text(history[start - 1]))
+            if tokens > token_budget:
+                break
+            start -= 1
+        return start
+
+    def needs_fold(self, history: list) -> bool:
+        """Whether the history outgrew the budget and folding isn't backing off."""
+        return (
+            self.token_budget > 0
+            and time.monotonic() >= self.retry_at
+            and self._window_start(history, self.token_budget) > self.summarized_turns
+        )
+
+    async def _summarize(self, turns: list, api_key: str, user_id=None) -> str:
+        """The summary with turns folded into it."""
+        messages = "\n".join(f"{turn.role}: {content_text(turn)}" for turn in turns)
+        prompt = self.SUMMARY_PROMPT.format(
+            summary=self.summary or "(empty)", messages=messages
+        )
+        request_tokens = estimate_tokens(prompt)
+
+        async def generate():
+            async with gemini_scheduler.slot(user_id, request_tokens) as request:
+                model = model_registry.get_model(self.summary_model, api_key)
+                with gemini_duration.time(operation="summary"):
+                    response = await asyncio.wait_for(
+                        model.generate_content_async(prompt),
+                        summary_retry_policy.timeout,
+                    )
+                record_usage(request, response, request_tokens, "summary")
+            return response
+
+        usage_tracker.check(user_id, request_tokens)
+        response = await summary_retry_policy.call(generate, "summarize conversation")
+        return response.text
+
+    async def fold(self, history: list, api_key: str, user_id=None) -> None:
+        """Folds the turns beyond the budget into the summary. On failure they stay
+        verbatim and folding is retried after SUMMARY_BACKOFF, doubling each time."""
+        if not self.needs_fold(history):
+            return
+        start = self._window_start(history, self.token_budget // 2)
+        while start < len(history) and history[start].role != "user":
+            start += 1
+        turns = history[self.summarized_turns : start]
+        try:
+            summary = await self._summarize(turns, api_key, user_id)
+        except Exception as e:
+            delay = min(SUMMARY_BACKOFF * 2**self.failures, SUMMARY_MAX_BACKOFF)
+            self.failures += 1
+            self.retry_at = time.monotonic() + delay
+            logging.warning(
+                f"Failed to summarize conversation: {e}, retrying in {delay:.0f}s"
+            )
+            return
+        self.summary = summary
+        self.summarized_turns = start
+        self.failures = 0
+        logging.info(f"Folded {len(turns)} turns into conversation summary")
+
+    def build(self, history: list) -> list:
+        """Returns the turns to send with the next message."""
+        if self.token_budget <= 0:
+            return history
+
+        window = history[self.summarized_turns :]
+        if self.summary:
+            window = [
+                glm.Content(
+                    role="user",
+                    parts=[
+                        glm.Part(
+                            text=f"Summary of our earlier conversation:\n{self.summary}"
+                        )
+                    ],
+                ),
+                glm.Content(role="model", parts=[glm.Part(text="OK")]),
+            ] + window
+        return window
+
 
 class GeminiChat:
 
     def __init__(
-        self, gemini_token: str, image=None, chat_history: list = None
+        self,
+        gemini_token: str,
+        image=None,
+        chat_history: list = None,
+        user_id: int | None = None,
     ) -> None:
         self.image = image
-        self.chat_history = chat_history
+        self.chat_history = list(chat_history or [])
+        self.user_id = user_id
+        # Identifies the conversation across copies, which __deepcopy__ keeps it for.
+        self.chat_uuid = uuid.uuid4().hex
+        # Awaited with the queue position when a request has to wait for its turn.
+        self.on_queued = None
+        self.context_window = ContextWindow()
+        self._fold_task = None
         self.GOOGLE_API_KEY = gemini_token
 
-        genai.configure(api_key=self.GOOGLE_API_KEY)
-
-        with open("./safety_settings.json", "r") as fp:
-            self.safety_settings = json.load(fp)
+        model_registry.configure(self.GOOGLE_API_KEY)
 
         logging.info("Initiated new chat model")
 
@@ -29,67 +404,254 @@ class GeminiChat:
         logging.warning(f"Failed to {operation}: {e}")
         raise ValueError(f"Failed to {operation}: {e}")
 
-    def _get_model(self, generative_model: str = "gemini-pro") -> genai.GenerativeModel:
+    def __deepcopy__(self, memo) -> "GeminiChat":
+        """Copies the conversation state and shares the SDK objects, which can't and
+        needn't be copied. Turns are never modified once they are in the history.
+        The copy keeps chat_uuid, as it is the same conversation."""
+        chat = copy.copy(self)
+        chat.chat_history = list(self.chat_history)
+        chat.context_window = copy.copy(self.context_window)
+        return chat
+
+    def to_state(self) -> dict:
+        """JSON serializable state of the conversation besides its history."""
+        return {
+            "user_id": self.user_id,
+            "summary": self.context_window.summary,
+            "summarized_turns": self.context_window.summarized_turns,
+        }
+
+    @classmethod
+    def from_state(
+        cls, gemini_token: str, state: dict, chat_history: list
+    ) -> "GeminiChat":
+        """Recreates a chat saved with to_state, ready to send the next message."""
+        chat = cls(
+            gemini_token=gemini_token,
+            chat_history=chat_history,
+            user_id=state.get("user_id"),
+        )
+        chat.context_window.summary = state.get("summary", "")
+        chat.context_window.summarized_turns = state.get("summarized_turns", 0)
+        chat.start_chat()
+        return chat
+
+    @property
+    def safety_settings(self) -> list:
+        """The registry's current settings, so a reload reaches open chats too."""
+        return model_registry.safety_settings
+
+    def _get_model(self, generative_model: str = CHAT_MODEL) -> genai.GenerativeModel:
         """Gets a generative model instance."""
         try:
-            logging.info("Trying to get generative model")
-            return genai.GenerativeModel(
-                generative_model, safety_settings=self.safety_settings
-            )
+            return model_registry.get_model(generative_model, self.GOOGLE_API_KEY)
         except Exception as e:
             self._handle_exception("get model", e)
 
-    def send_image(self, message_text: str | None = None) -> str:
-        """Sends an image and message to the model and generates a response."""
+    async def _generate_image_response(
+        self, contents: list, request_tokens: int, on_queued=None
+    ):
+        async with gemini_scheduler.slot(
+            self.user_id, request_tokens, on_queued
+        ) as request:
+            started = time.monotonic()
+            model = self._get_model(VISION_MODEL)
+            response = await resolve_response(
+                model.generate_content_async(contents, stream=True),
+                "vision",
+                gemini_retry_policy.timeout,
+            )
+            vision_latency.record(time.monotonic() - started)
+            record_usage(request, response, request_tokens, "vision")
+        return response
+
+    async def send_image(self, message_text: str | None = None) -> str:
+        """Sends one or more images and message to the model and generates a response."""
         message_text = message_text or "Please describe this photo"
+        images = self.image if isinstance(self.image, list) else [self.image]
+        contents = [message_text, *images]
+        request_tokens = estimate_tokens(message_text) + IMAGE_TOKENS * len(images)
+        usage_tracker.check(self.user_id, request_tokens)
         try:
-            model = self._get_model("gemini-pro-vision")
-            response = model.generate_content([message_text, self.image], stream=True)
-            response.resolve()
+            response = await gemini_retry_policy.call(
+                lambda: self._generate_image_response(
+                    contents, request_tokens, self.on_queued
+                ),
+                "send image",
+                hedge_call=lambda: self._generate_image_response(
+                    contents, request_tokens
+                ),
+                latency=vision_latency,
+            )
             logging.info("Recieved response from Gemini")
             return "".join([text for text in response.text])
+        except (QueueFullError, CircuitOpenError):
+            raise
         except Exception as e:
             self._handle_exception("send image", e)
-            return "Couldn't reach out to Google Gemini. Try Again..."
 
     def start_chat(self) -> None:
         """Starts a new chat session."""
         try:
             model = self._get_model()
-            self.chat = model.start_chat(history=self.chat_history)
+            self.chat = model.start_chat()
             logging.info("Start new conversation")
         except Exception as e:
             self._handle_exception("start chat", e)
 
-    def send_message(self, message_text: str) -> str:
+    def _build_context(self) -> list:
+        """Windowed context of the full history to send with the next message."""
+        return self.context_window.build(self.chat_history)
+
+    def _schedule_fold(self) -> None:
+        """Folds old turns into the summary in the background, so the next message
+        doesn't wait for it."""
+        if self._fold_task is not None and not self._fold_task.done():
+            return
+        if self.context_window.needs_fold(self.chat_history):
+            self._fold_task = asyncio.create_task(
+                self.context_window.fold(
+                    self.chat_history, self.GOOGLE_API_KEY, self.user_id
+                )
+            )
+
+    async def _send_chat_message(
+        self, message_text: str, context: list, request_tokens: int, on_queued=None
+    ):
+        """Sends the message in a new session over context, so failed, retried and
+        hedged attempts don't share session state."""
+        async with gemini_scheduler.slot(
+            self.user_id, request_tokens, on_queued
+        ) as request:
+            started = time.monotonic()
+            chat = self._get_model().start_chat(history=context)
+            response = await resolve_response(
+                chat.send_message_async(message_text, stream=True),
+                "chat",
+                gemini_retry_policy.timeout,
+            )
+            chat_latency.record(time.monotonic() - started)
+            record_usage(request, response, request_tokens, "chat")
+        return chat, response
+
+    def _record_turn(self) -> None:
+        """Appends the last request and response of the session to the full history."""
+        self.chat_history.extend(self.chat.history[-2:])
+
+    def record_turn(self, message_text: str, response_text: str) -> None:
+        """Appends a request and a response obtained without the model, e.g. from cache."""
+        self.chat_history.extend(
+            [
+                glm.Content(role="user", parts=[glm.Part(text=message_text)]),
+                glm.Content(role="model", parts=[glm.Part(text=response_text)]),
+            ]
+        )
+        self._schedule_fold()
+
+    def _estimate_request_tokens(self, message_text: str) -> int:
+        history_tokens = sum(
+            estimate_tokens(content_text(content)) for content in self.chat_history
+        )
+        if self.context_window.token_budget > 0:
+            history_tokens = min(history_tokens, self.context_window.token_budget)
+        return estimate_tokens(message_text) + history_tokens
+
+    async def send_message(self, message_text: str) -> str:
         """Sends a message to the chat session and returns the response."""
+        request_tokens = self._estimate_request_tokens(message_text)
+        usage_tracker.check(self.user_id, request_tokens)
         try:
-            response = self.chat.send_message(message_text, stream=True)
-            response.resolve()
+            context = self._build_context()
+            self.chat, response = await gemini_retry_policy.call(
+                lambda: self._send_chat_message(
+                    message_text, context, request_tokens, self.on_queued
+                ),
+                "send message",
+                hedge_call=lambda: self._send_chat_message(
+                    message_text, context, request_tokens
+                ),
+                latency=chat_latency,
+            )
+            self._record_turn()
+            self._schedule_fold()
             logging.info("Recieved response from Gemini")
             return "".join([text for text in response.text])
+        except (QueueFullError, CircuitOpenError):
+            raise
         except Exception as e:
             self._handle_exception("send message", e)
-            return "Couldn't reach out to Google Gemini. Try Again..."
 
-    def get_chat_title(self) -> str:
-        """Gets a short title for the conversation."""
+    async def stream_message(self, message_text: str) -> AsyncIterator[str]:
+        """Sends a message to the chat session and yields the response text as it arrives.
+        Attempts are retried only until the first chunk has been yielded."""
+        request_tokens = self._estimate_request_tokens(message_text)
+        usage_tracker.check(self.user_id, request_tokens)
+        policy = gemini_retry_policy
+        try:
+            context = self._build_context()
+            for attempt in range(policy.max_attempts):
+                policy.breaker.check()
+                yielded = False
+                try:
+                    async with gemini_scheduler.slot(
+                        self.user_id, request_tokens, self.on_queued
+                    ) as request:
+                        chat = self._get_model().start_chat(history=context)
+                        started = time.perf_counter()
+                        response = await asyncio.wait_for(
+                            chat.send_message_async(message_text, stream=True),
+                            policy.timeout,
+                        )
+                        gemini_ttft.observe(
+                            time.perf_counter() - started, operation="stream"
+                        )
+                        async for chunk in response:
+                            yielded = True
+                            yield chunk.text
+                        gemini_duration.observe(
+                            time.perf_counter() - started, operation="stream"
+                        )
+                        record_usage(request, response, request_tokens, "stream")
+                except (QueueFullError, CircuitOpenError):
+                    raise
+                except Exception as e:
+                    if yielded:
+                        policy.record_error(e)
+                        raise
+                    await policy.retry_or_raise(e, attempt, "stream message")
+                    continue
+
+                policy.breaker.record_success()
+                self.chat = chat
+                self._record_turn()
+                self._schedule_fold()
+                logging.info("Recieved streamed response from Gemini")
+                return
+        except (QueueFullError, CircuitOpenError):
+            raise
+        except Exception as e:
+            self._handle_exception("stream message", e)
+
+    async def get_chat_title(self) -> str:
+        """Gets a short title for the conversation from the beginning of its history."""
         try:
-            return self.send_message(
-                "Write a one-line short title up to 10 words for this conversation in plain text."
+            return await generate_chat_title(
+                title_excerpt(self.chat_history), self.GOOGLE_API_KEY, self.user_id
             )
         except Exception as e:
             self._handle_exception("get chat title", e)
 
     def get_chat_history(self):
-        """Gets the chat history."""
+        """Gets the full chat history, including turns folded into the summary."""
         try:
-            return self.chat.history
+            return self.chat_history
         except Exception as e:
             self._handle_exception("get chat history", e)
 
     def close(self) -> None:
         """Closes the chat and cleans history."""
         logging.info("Closed model instance")
+        if self._fold_task is not None:
+            self._fold_task.cancel()
         self.chat = None
         self.chat_history = []
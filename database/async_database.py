@@ -0,0 +1,61 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from database.database import create_connection
+from helpers.metrics import registry
+
+
+query_duration = registry.histogram(
+    "db_query_duration_seconds",
+    "Duration of database calls including the wait for a free connection.",
+    ["query"],
+)
+
+
+class AsyncDatabase:
+    """Runs the query functions of database.database on a small thread pool,
+    each worker thread using its own SQLite connection, so queries never block
+    the event loop.
+
+    Usage: await db.run(select_conversation_by_id, (user_id, conv_id))
+    """
+
+    def __init__(self, db_file: str, max_workers: int = 2) -> None:
+        self.db_file = db_file
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="sqlite"
+        )
+
+    def _get_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = create_connection(self.db_file, check_same_thread=False)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, func, *args):
+        return func(self._get_connection(), *args)
+
+    async def run(self, func, *args):
+        """Calls func(conn, *args) in a worker thread and returns its result."""
+        loop = asyncio.get_running_loop()
+        with query_duration.time(query=getattr(func, "__name__", "query")):
+            return await loop.run_in_executor(
+                self._executor, partial(self._call, func, *args)
+            )
+
+    def close(self) -> None:
+        """Waits for pending queries and closes all connections."""
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
@@ -2,15 +2,21 @@ import sqlite3
 from sqlite3 import Error
 
 
-def create_connection(db_file):
+def create_connection(db_file, check_same_thread=True):
     """create a database connection to the SQLite database
-        specified by db_file
+        specified by db_file, in WAL mode with relaxed fsync
     :param db_file: database file
+    :param check_same_thread: set False when the connection is used by a worker thread
     :return: Connection object or None
     """
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(
+            db_file, check_same_thread=check_same_thread, cached_statements=256
+        )
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA busy_timeout=5000;")
     except Error as e:
         print(e)
 
@@ -24,6 +30,10 @@ def create_table(conn):
     """
     try:
         c = conn.cursor()
+        c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_conversation_counts';"
+        )
+        counts_exist = c.fetchone() is not None
         c.execute(
             """
             CREATE TABLE IF NOT EXISTS conversations (
@@ -34,6 +44,81 @@ def create_table(conn):
             );
             """
         )
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                conv_id STRING NOT NULL,
+                seq INTEGER NOT NULL,
+                role STRING NOT NULL,
+                content BLOB NOT NULL,
+                PRIMARY KEY (conv_id, seq)
+            ) WITHOUT ROWID;
+            """
+        )
+        c.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_conversations_user_id
+            ON conversations (user_id, id);
+            """
+        )
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_conversation_counts (
+                user_id INTEGER PRIMARY KEY NOT NULL,
+                count INTEGER NOT NULL
+            );
+            """
+        )
+        c.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS conversations_count_insert
+            AFTER INSERT ON conversations
+            BEGIN
+                INSERT INTO user_conversation_counts(user_id, count)
+                VALUES (NEW.user_id, 1)
+                ON CONFLICT(user_id) DO UPDATE SET count = count + 1;
+            END;
+            """
+        )
+        c.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS conversations_count_delete
+            AFTER DELETE ON conversations
+            BEGIN
+                UPDATE user_conversation_counts SET count = count - 1
+                WHERE user_id = OLD.user_id;
+            END;
+            """
+        )
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key STRING PRIMARY KEY NOT NULL,
+                response STRING NOT NULL,
+                created_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            """
+        )
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_usage (
+                user_id INTEGER NOT NULL,
+                day STRING NOT NULL,
+                requests INTEGER NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                response_tokens INTEGER NOT NULL,
+                PRIMARY KEY (user_id, day)
+            ) WITHOUT ROWID;
+            """
+        )
+        if not counts_exist:
+            c.execute(
+                """
+                INSERT OR REPLACE INTO user_conversation_counts(user_id, count)
+                SELECT user_id, COUNT(*) FROM conversations GROUP BY user_id;
+                """
+            )
+            conn.commit()
     except Error as e:
         print(e)
 
@@ -53,16 +138,27 @@ def create_conversation(conn, conversation):
     return cur.lastrowid
 
 
+def update_conversation_title(conn, conversation):
+    """
+    Replace the title of a conversation
+    :param conn:
+    :param conversation: (title, conv_id)
+    :return:
+    """
+    conn.execute("UPDATE conversations SET title=? WHERE conv_id=?;", conversation)
+    conn.commit()
+
+
 def get_user_conversation_count(conn, user_id):
     """
-    Query count of all conversations for each user
+    Query count of all conversations for each user, maintained by triggers
     :param conn: the Connection object
     :param user_id:
     :return count of conversations
     """
     cur = conn.cursor()
     cur.execute(
-        "SELECT COUNT(*) FROM conversations WHERE user_id=?;",
+        "SELECT count FROM user_conversation_counts WHERE user_id=?;",
         (user_id,),
     )
 
@@ -99,6 +195,41 @@ def select_conversations_by_user(conn, conversation_page):
     ]
 
 
+def select_conversations_by_cursor(conn, conversation_page):
+    """
+    Query a page of conversations next to a known conversation id (keyset pagination)
+    :param conn: the Connection object
+    :param conversation_page: (user_id, direction, conv_row_id, skip, limit):
+        direction "<" selects conversations older than conv_row_id,
+        ">" selects conversations newer than conv_row_id
+    :return list of conversations, newest first
+    """
+    user_id, direction, conv_row_id, skip, limit = conversation_page
+    cur = conn.cursor()
+    if direction == "<":
+        cur.execute(
+            "SELECT * FROM conversations WHERE user_id=? AND id<? ORDER BY id DESC LIMIT ? OFFSET ?;",
+            (user_id, conv_row_id, limit, skip),
+        )
+        results = cur.fetchall()
+    else:
+        cur.execute(
+            "SELECT * FROM conversations WHERE user_id=? AND id>? ORDER BY id ASC LIMIT ? OFFSET ?;",
+            (user_id, conv_row_id, limit, skip),
+        )
+        results = cur.fetchall()[::-1]
+
+    return [
+        {
+            "id": item[0],
+            "conversation_id": item[1],
+            "user_id": item[2],
+            "title": item[3],
+        }
+        for item in results
+    ]
+
+
 def select_conversation_by_id(conn, conversation):
     """
     Query conversation by conv_id
@@ -128,6 +259,295 @@ def delete_conversation_by_id(conn, conversation):
     cur.execute(
         "DELETE FROM conversations WHERE user_id=? AND conv_id=?;", conversation
     )
+    if cur.rowcount:
+        cur.execute("DELETE FROM messages WHERE conv_id=?;", (conversation[1],))
     conn.commit()
 
     return
+
+
+def get_next_message_seq(conn, conv_id):
+    """
+    Query sequence number of the next turn of a conversation
+    :param conn: the Connection object
+    :param conv_id:
+    :return number of turns already stored
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE conv_id=?;",
+        (conv_id,),
+    )
+
+    return cur.fetchone()[0]
+
+
+def insert_messages(conn, conv_id, messages, start_seq):
+    """
+    Append turns to a conversation, earlier turns are not rewritten
+    :param conn: the Connection object
+    :param conv_id:
+    :param messages: list of (role, content) tuples
+    :param start_seq: sequence number of the first turn in messages
+    :return:
+    """
+    cur = conn.cursor()
+    cur.executemany(
+        "INSERT OR REPLACE INTO messages(conv_id,seq,role,content) VALUES(?,?,?,?);",
+        [
+            (conv_id, seq, role, content)
+            for seq, (role, content) in enumerate(messages, start_seq)
+        ],
+    )
+    conn.commit()
+
+    return
+
+
+def save_conversation(conn, conversation, messages, start_seq):
+    """
+    Append turns to a conversation and create its row in one transaction, so
+    messages are never stored without their conversation
+    :param conn: the Connection object
+    :param conversation: (conv_id, user_id, title)
+    :param messages: list of (role, content) tuples
+    :param start_seq: sequence number of the first turn in messages
+    :return:
+    """
+    conv_id = conversation[0]
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO messages(conv_id,seq,role,content) VALUES(?,?,?,?);",
+            [
+                (conv_id, seq, role, content)
+                for seq, (role, content) in enumerate(messages, start_seq)
+            ],
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO conversations(conv_id,user_id,title) VALUES(?,?,?);",
+            conversation,
+        )
+
+    return
+
+
+def select_messages(conn, conv_id):
+    """
+    Query all turns of a conversation in order
+    :param conn: the Connection object
+    :param conv_id:
+    :return list of (role, content) tuples
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT role, content FROM messages WHERE conv_id=? ORDER BY seq;",
+        (conv_id,),
+    )
+
+    return cur.fetchall()
+
+
+def select_cached_response(conn, cache_entry):
+    """
+    Query a cached response that is not older than min_created_at
+    :param conn: the Connection object
+    :param cache_entry: (key, min_created_at):
+    :return (response, created_at) or None
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT response, created_at FROM response_cache WHERE key=? AND created_at>=?;",
+        cache_entry,
+    )
+
+    return cur.fetchone()
+
+
+def insert_cached_response(conn, cache_entry):
+    """
+    Insert or refresh a cached response
+    :param conn: the Connection object
+    :param cache_entry: (key, response, created_at):
+    :return:
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT OR REPLACE INTO response_cache(key,response,created_at) VALUES(?,?,?);",
+        cache_entry,
+    )
+    conn.commit()
+
+    return
+
+
+def delete_expired_responses(conn, min_created_at):
+    """
+    Delete cached responses older than min_created_at
+    :param conn: the Connection object
+    :param min_created_at:
+    :return count of deleted responses
+    """
+    cur = conn.cursor()
+    cur.execute("DELETE FROM response_cache WHERE created_at<?;", (min_created_at,))
+    conn.commit()
+
+    return cur.rowcount
+
+
+def select_usage_since(conn, first_day):
+    """
+    Query the Gemini usage of all users from first_day on
+    :param conn: the Connection object
+    :param first_day: UTC day as YYYY-MM-DD
+    :return list of (user_id, day, requests, prompt_tokens, response_tokens) tuples
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT user_id, day, requests, prompt_tokens, response_tokens FROM user_usage WHERE day>=?;",
+        (first_day,),
+    )
+
+    return cur.fetchall()
+
+
+def add_usage_batch(conn, rows):
+    """
+    Add Gemini usage to the stored totals in one transaction
+    :param conn: the Connection object
+    :param rows: list of (user_id, day, requests, prompt_tokens, response_tokens) tuples
+    :return:
+    """
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO user_usage(user_id,day,requests,prompt_tokens,response_tokens)
+            VALUES(?,?,?,?,?)
+            ON CONFLICT(user_id, day) DO UPDATE SET
+                requests = requests + excluded.requests,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                response_tokens = response_tokens + excluded.response_tokens;
+            """,
+            rows,
+        )
+
+
+def create_persistence_tables(conn):
+    """
+    Create the tables that keep bot state across restarts
+    :param conn: Connection object
+    :return:
+    """
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS persisted_user_data (
+            user_id INTEGER PRIMARY KEY NOT NULL,
+            data TEXT NOT NULL,
+            history BLOB
+        );
+        CREATE TABLE IF NOT EXISTS persisted_conversation_states (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS persisted_history (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content BLOB NOT NULL,
+            PRIMARY KEY (user_id, key, seq)
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.commit()
+
+
+def select_persisted_user_data(conn):
+    """
+    Query persisted user data of all users
+    :param conn: the Connection object
+    :return list of (user_id, data, history) tuples
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT user_id, data, history FROM persisted_user_data;")
+
+    return cur.fetchall()
+
+
+def select_persisted_conversation_states(conn, name):
+    """
+    Query persisted states of a conversation handler
+    :param conn: the Connection object
+    :param name: name of the conversation handler
+    :return list of (key, state) tuples
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT key, state FROM persisted_conversation_states WHERE name=?;", (name,)
+    )
+
+    return cur.fetchall()
+
+
+def select_persisted_history(conn):
+    """
+    Query persisted chat history turns of all users
+    :param conn: the Connection object
+    :return list of (user_id, key, role, content) tuples in turn order
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT user_id, key, role, content FROM persisted_history ORDER BY user_id, key, seq;"
+    )
+
+    return cur.fetchall()
+
+
+def save_persistence_batch(
+    conn,
+    user_rows,
+    dropped_user_ids,
+    conversation_rows,
+    reset_histories=(),
+    history_rows=(),
+):
+    """
+    Write a batch of persistence changes in one transaction
+    :param conn: the Connection object
+    :param user_rows: list of (user_id, data, history) tuples
+    :param dropped_user_ids: list of user ids whose data and history are deleted
+    :param conversation_rows: list of (name, key, state) tuples, state None deletes
+    :param reset_histories: list of (user_id, key) tuples whose history turns are deleted
+    :param history_rows: list of (user_id, key, seq, role, content) tuples to append
+    :return:
+    """
+    with conn:
+        conn.executemany(
+            "DELETE FROM persisted_history WHERE user_id=?;",
+            [(user_id,) for user_id in dropped_user_ids],
+        )
+        conn.executemany(
+            "DELETE FROM persisted_history WHERE user_id=? AND key=?;",
+            reset_histories,
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO persisted_history(user_id,key,seq,role,content) VALUES(?,?,?,?,?);",
+            history_rows,
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO persisted_user_data(user_id,data,history) VALUES(?,?,?);",
+            user_rows,
+        )
+        conn.executemany(
+            "DELETE FROM persisted_user_data WHERE user_id=?;",
+            [(user_id,) for user_id in dropped_user_ids],
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO persisted_conversation_states(name,key,state) VALUES(?,?,?);",
+            [row for row in conversation_rows if row[2] is not None],
+        )
+        conn.executemany(
+            "DELETE FROM persisted_conversation_states WHERE name=? AND key=?;",
+            [row[:2] for row in conversation_rows if row[2] is None],
+        )
@@ -0,0 +1,137 @@
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+from database.database import select_cached_response, insert_cached_response
+
+
+class HistoryCache:
+    """LRU cache of loaded conversation histories bounded by a total size in bytes."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> list | None:
+        """Returns a copy of the cached history, or None when it isn't cached."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return list(entry[0])
+
+    def put(self, key: str, history: list, size: int) -> None:
+        """Caches history and evicts least recently used entries over the budget."""
+        self.invalidate(key)
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = (list(history), size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+
+    def invalidate(self, key: str) -> None:
+        """Drops the cached history of a conversation if present."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+        }
+
+
+class ResponseCache:
+    """Content-addressed cache of Gemini responses for stateless requests.
+
+    Entries live in an in-memory LRU bounded by max_entries and expire after ttl
+    seconds. When db is set to an AsyncDatabase, entries are also kept in the
+    response_cache table and survive restarts.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, db=None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db = db
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(
+        model_name: str, safety_settings: list, prompt: str, *images: bytes
+    ) -> str:
+        digest = hashlib.sha256()
+        for part in (
+            model_name.encode(),
+            json.dumps(safety_settings, sort_keys=True).encode(),
+            (prompt or "").encode(),
+            *images,
+        ):
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _remember(self, key: str, response: str, expires_at: float) -> None:
+        self._entries[key] = (response, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str) -> str | None:
+        """Returns the cached response, or None when it is missing or expired."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            response, expires_at = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return response
+            del self._entries[key]
+
+        if self.db is not None:
+            row = await self.db.run(
+                select_cached_response, (key, time.time() - self.ttl)
+            )
+            if row is not None:
+                response, created_at = row
+                self._remember(key, response, created_at + self.ttl)
+                self.persistent_hits += 1
+                return response
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, response: str) -> None:
+        created_at = time.time()
+        self._remember(key, response, created_at + self.ttl)
+        if self.db is not None:
+            await self.db.run(insert_cached_response, (key, response, created_at))
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+        }
@@ -0,0 +1,207 @@
+"""Versioned file format for chat histories.
+
+A file starts with a 5 byte header: the magic ``GBH``, the format version and the
+compression of the body. The body is a sequence of records, one per turn: a
+4 byte big-endian length followed by the turn serialized as a protobuf
+``Content`` message, the same bytes the messages table stores. Unlike pickle, the
+format doesn't depend on the installed SDK classes and is safe to read from
+untrusted files.
+
+Whole histories are decoded with a single protobuf parse: the records are framed
+as the repeated ``contents`` field of a ``GenerateContentRequest``, so protobuf
+parses all turns in one call instead of one call per turn.
+"""
+
+import io
+import gzip
+import struct
+from collections import deque
+from typing import BinaryIO, Iterator
+
+import google.ai.generativelanguage as glm
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b"GBH"
+VERSION = 1
+HEADER = struct.Struct(">3sBB")
+RECORD_LENGTH = struct.Struct(">I")
+FILE_EXTENSION = ".history"
+
+COMPRESSIONS = {"none": 0, "gzip": 1, "zstd": 2}
+# Tag of GenerateContentRequest.contents: field 2, length-delimited.
+CONTENTS_TAG = b"\x12"
+
+
+class HistoryFormatError(ValueError):
+    """Raised for files that aren't histories in a supported version."""
+
+
+def _compressed_writer(fp: BinaryIO, compression: str):
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=fp, mode="wb", compresslevel=6, mtime=0)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=3).stream_writer(fp, closefd=False)
+    return None
+
+
+def _body_reader(fp: BinaryIO, compression: int) -> BinaryIO:
+    if compression == COMPRESSIONS["gzip"]:
+        return gzip.GzipFile(fileobj=fp, mode="rb")
+    if compression == COMPRESSIONS["zstd"]:
+        if zstandard is None:
+            raise RuntimeError("zstd compressed history needs the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(fp, closefd=False)
+    if compression == COMPRESSIONS["none"]:
+        return fp
+    raise HistoryFormatError(f"Unknown history compression {compression}")
+
+
+def write_history(fp: BinaryIO, history: list, compression: str = "none") -> None:
+    """Writes history turns to a binary file object."""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown history compression {compression!r}")
+    fp.write(HEADER.pack(MAGIC, VERSION, COMPRESSIONS[compression]))
+
+    writer = _compressed_writer(fp, compression)
+    out = writer or fp
+    for content in history:
+        record = glm.Content.serialize(content)
+        out.write(RECORD_LENGTH.pack(len(record)))
+        out.write(record)
+    if writer is not None:
+        writer.close()
+
+
+def dumps(history: list, compression: str = "none") -> bytes:
+    buffer = io.BytesIO()
+    write_history(buffer, history, compression)
+    return buffer.getvalue()
+
+
+def _read_header(fp: BinaryIO) -> int:
+    """Checks the header and returns the compression of the body."""
+    header = fp.read(HEADER.size)
+    if len(header) != HEADER.size:
+        raise HistoryFormatError("Truncated history header")
+    magic, version, compression = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise HistoryFormatError("Not a history file")
+    if version != VERSION:
+        raise HistoryFormatError(f"Unsupported history version {version}")
+    return compression
+
+
+def _read_length(body: BinaryIO) -> int | None:
+    prefix = body.read(RECORD_LENGTH.size)
+    if not prefix:
+        return None
+    if len(prefix) != RECORD_LENGTH.size:
+        raise HistoryFormatError("Truncated history record")
+    return RECORD_LENGTH.unpack(prefix)[0]
+
+
+def _read_record(body: BinaryIO, length: int) -> bytes:
+    record = body.read(length)
+    if len(record) != length:
+        raise HistoryFormatError("Truncated history record")
+    return record
+
+
+def _iter_body(fp: BinaryIO, compression: int) -> Iterator[bytes]:
+    body = _body_reader(fp, compression)
+    while (length := _read_length(body)) is not None:
+        yield _read_record(body, length)
+
+
+def iter_records(fp: BinaryIO) -> Iterator[bytes]:
+    """Yields the serialized turns of a history file one by one without decoding."""
+    yield from _iter_body(fp, _read_header(fp))
+
+
+def _last_records(fp: BinaryIO, last: int) -> list[bytes]:
+    compression = _read_header(fp)
+    if compression != COMPRESSIONS["none"] or not fp.seekable():
+        return list(deque(_iter_body(fp, compression), maxlen=last))
+
+    # Uncompressed files are scanned by seeking over the records.
+    positions = deque(maxlen=last)
+    while (length := _read_length(fp)) is not None:
+        positions.append((fp.tell(), length))
+        fp.seek(length, io.SEEK_CUR)
+    records = []
+    for position, length in positions:
+        fp.seek(position)
+        records.append(_read_record(fp, length))
+    return records
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _decode_records(records: list[bytes]) -> list:
+    """Decodes serialized turns with one protobuf parse."""
+    framed = []
+    for record in records:
+        framed.append(CONTENTS_TAG + _varint(len(record)))
+        framed.append(record)
+    request = glm.GenerateContentRequest.pb().FromString(b"".join(framed))
+    return [glm.Content.wrap(content) for content in request.contents]
+
+
+def _split_body(body: bytes) -> list[bytes]:
+    """Splits a body read at once into its records."""
+    records = []
+    offset = 0
+    while offset < len(body):
+        if offset + RECORD_LENGTH.size > len(body):
+            raise HistoryFormatError("Truncated history record")
+        (length,) = RECORD_LENGTH.unpack_from(body, offset)
+        offset += RECORD_LENGTH.size
+        if offset + length > len(body):
+            raise HistoryFormatError("Truncated history record")
+        records.append(body[offset : offset + length])
+        offset += length
+    return records
+
+
+def iter_history(fp: BinaryIO) -> Iterator:
+    """Yields the turns of a history file as they are read."""
+    for record in iter_records(fp):
+        yield glm.Content.deserialize(record)
+
+
+def read_history(fp: BinaryIO, last: int | None = None) -> list:
+    """Reads all turns, or only decodes the last ones when last is given."""
+    if last is None:
+        body = _body_reader(fp, _read_header(fp)).read()
+        return _decode_records(_split_body(body))
+    if last <= 0:
+        return []
+    return _decode_records(_last_records(fp, last))
+
+
+def loads(data: bytes, last: int | None = None) -> list:
+    return read_history(io.BytesIO(data), last)
+
+
+def load_history_file(path: str, last: int | None = None) -> list:
+    with open(path, "rb") as fp:
+        return read_history(fp, last)
+
+
+def save_history_file(path: str, history: list, compression: str = "none") -> None:
+    with open(path, "wb") as fp:
+        write_history(fp, history, compression)
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 10 * 1024 * 1024
+MAX_LINE_SIZE = 8 * 1024
+MAX_HEADERS = 100
+# Seconds a keep-alive connection may wait for its next request.
+IDLE_TIMEOUT = 60
+# Seconds for the rest of a request once its first line arrived.
+REQUEST_TIMEOUT = 30
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+# handler(method, path, headers, body) -> (status, content type, body)
+RequestHandler = Callable[[str, str, dict, bytes], Awaitable[tuple[int, str, bytes]]]
+
+
+class HTTPServer:
+    """Minimal asyncio HTTP/1.1 server with keep-alive, enough for webhooks,
+    metrics and local fakes without extra dependencies.
+
+    Clients that send nothing or trickle their requests are disconnected after
+    IDLE_TIMEOUT and REQUEST_TIMEOUT, request lines and headers are limited in
+    size and number, and connections beyond max_connections are closed right
+    away."""
+
+    def __init__(
+        self,
+        handler: RequestHandler,
+        host: str,
+        port: int,
+        max_connections: int = 100,
+    ) -> None:
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.rejected = 0
+        self._server = None
+        self._connections = set()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, limit=MAX_LINE_SIZE
+        )
+        # Port 0 picks a free port, expose the one actually used.
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            # Open connections, like idle keep-alives or long polls, end now too.
+            for task in self._connections:
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+        if not request_line.strip():
+            return None
+        return await asyncio.wait_for(
+            self._read_rest(reader, request_line), REQUEST_TIMEOUT
+        )
+
+    async def _read_rest(self, reader: asyncio.StreamReader, request_line: bytes):
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        for _ in range(MAX_HEADERS + 1):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError("Too many header lines")
+
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_SIZE:
+            return method, target, headers, None
+        body = await reader.readexactly(length) if length else b""
+        return method, target, headers, body
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        if len(self._connections) >= self.max_connections:
+            self.rejected += 1
+            writer.close()
+            return
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+
+                method, target, headers, body = request
+                if body is None:
+                    status, content_type, payload = 413, "text/plain", b""
+                else:
+                    try:
+                        status, content_type, payload = await self.handler(
+                            method, target, headers, body
+                        )
+                    except Exception as e:
+                        logger.exception("HTTP handler failed: %s", e)
+                        status, content_type, payload = 500, "text/plain", b""
+
+                keep_alive = (
+                    body is not None
+                    and headers.get("connection", "").lower() != "close"
+                )
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                        f"Content-Type: {content_type}\r\n"
+                        f"Content-Length: {len(payload)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                        "\r\n"
+                    ).encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.TimeoutError,
+            ConnectionError,
+            ValueError,
+        ):
+            pass
+        except asyncio.CancelledError:
+            # The server is stopping. Ending normally keeps asyncio from logging
+            # the cancelled connection as an error.
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
@@ -0,0 +1,93 @@
+import io
+import os
+import asyncio
+import logging
+
+import PIL.Image
+from telegram import PhotoSize
+
+from helpers.metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+IMAGE_TARGET_SIZE = int(os.getenv("IMAGE_TARGET_SIZE", "1024"))
+# Photos up to this much larger than the target are sent without resizing, so
+# Telegram's 1280 pixel size passes through for the default target.
+IMAGE_SIZE_TOLERANCE = float(os.getenv("IMAGE_SIZE_TOLERANCE", "0.25"))
+JPEG_QUALITY = 85
+
+
+class ImageStats:
+    """Counts images and bytes sent to Gemini."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.resized = 0
+        self.bytes_uploaded = 0
+
+    def record(self, size: int, resized: bool) -> None:
+        self.requests += 1
+        self.resized += resized
+        self.bytes_uploaded += size
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "resized": self.resized,
+            "bytes_uploaded": self.bytes_uploaded,
+        }
+
+
+image_stats = ImageStats()
+registry.add_stats(
+    "gemini_images",
+    image_stats.stats,
+    counters=["requests", "resized", "bytes_uploaded"],
+)
+
+
+def max_side(target_size: int) -> int:
+    """Longest side of a photo that is sent without resizing."""
+    return int(target_size * (1 + IMAGE_SIZE_TOLERANCE))
+
+
+def select_photo_size(
+    photo_sizes: tuple[PhotoSize, ...], target_size: int = IMAGE_TARGET_SIZE
+) -> PhotoSize:
+    """Returns the largest photo size that can be sent without resizing, or the
+    smallest one when all of them are larger."""
+    photo_sizes = sorted(photo_sizes, key=lambda photo: photo.width * photo.height)
+    fitting = [
+        photo
+        for photo in photo_sizes
+        if max(photo.width, photo.height) <= max_side(target_size)
+    ]
+    return fitting[-1] if fitting else photo_sizes[0]
+
+
+def resize_jpeg(data: bytes, target_size: int = IMAGE_TARGET_SIZE) -> bytes:
+    """Decodes data at reduced scale with JPEG draft mode and re-encodes it so the
+    longest side is at most target_size."""
+    with PIL.Image.open(io.BytesIO(data)) as image:
+        image.draft("RGB", (target_size, target_size))
+        image = image.convert("RGB")
+        image.thumbnail((target_size, target_size))
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=JPEG_QUALITY)
+        return buf.getvalue()
+
+
+async def prepare_image(
+    photo: PhotoSize, data: bytes, target_size: int = IMAGE_TARGET_SIZE
+) -> dict:
+    """Returns the downloaded photo as an inline blob for Gemini, passing Telegram's
+    JPEG through untouched unless it is larger than target_size and the tolerance."""
+    resized = max(photo.width, photo.height) > max_side(target_size)
+    if resized:
+        data = await asyncio.to_thread(resize_jpeg, data, target_size)
+
+    image_stats.record(len(data), resized)
+    logger.info(f"Uploading image of {len(data)} bytes, resized: {resized}")
+
+    return {"mime_type": "image/jpeg", "data": data}
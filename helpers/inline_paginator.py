@@ -110,11 +110,17 @@ class InlineKeyboardPaginator:
             keyboard.append(
                 InlineKeyboardButton(
                     text=str(keyboard_dict[key]),
-                    callback_data=self.data_pattern.format(page=key),
+                    callback_data=self._page_data(key),
                 )
             )
         return _buttons_to_dict(keyboard)
 
+    def _page_data(self, page):
+        """data_pattern may be a format string or a function of the page number"""
+        if callable(self.data_pattern):
+            return self.data_pattern(page)
+        return self.data_pattern.format(page=page)
+
     @property
     def keyboard(self):
         if self._keyboard is None:
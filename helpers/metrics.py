@@ -0,0 +1,212 @@
+"""Prometheus metrics without extra dependencies.
+
+Counters and histograms are updated where things happen. Numbers that other
+components already keep, like cache hits or queue depths, are read from their
+stats() when the metrics are scraped. metrics_server() serves everything in the
+Prometheus text format.
+"""
+
+import time
+import bisect
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+from helpers.http_server import HTTPServer
+
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# (metric name, labels, value)
+Sample = tuple[str, dict, float]
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_sample(name: str, labels: dict, value: float) -> str:
+    if labels:
+        label_text = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+        name = f"{name}{{{label_text}}}"
+    return f"{name} {_format_value(value)}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels[n]) for n in self.labelnames), 0)
+
+    def samples(self) -> Iterator[Sample]:
+        for key, value in sorted(self._values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., count, sum]
+        self._values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        series = self._values.get(tuple(str(labels[n]) for n in self.labelnames))
+        return sum(series[:-1]) if series else 0
+
+    def samples(self) -> Iterator[Sample]:
+        for key, series in sorted(self._values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), series[:-1]):
+                cumulative += count
+                le = _format_value(bound)
+                yield f"{self.name}_bucket", {**labels, "le": le}, cumulative
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, series[-1]
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._stats = {}
+
+    def _register(self, metric_class, name: str, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+        elif not isinstance(metric, metric_class):
+            raise ValueError(f"Metric {name} is already registered as {metric.type}")
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def add_stats(
+        self,
+        prefix: str,
+        stats: Callable[[], dict],
+        counters: Iterable[str] = (),
+        key_label: str = "type",
+    ) -> None:
+        """Exposes the values of a stats() dict as {prefix}_{key} gauges, or as
+        {prefix}_{key}_total counters for the keys in counters. A string value
+        becomes a gauge of 1 labelled state, a dict one series per entry labelled
+        key_label. Adding stats under the same prefix again replaces them."""
+        self._stats[prefix] = (stats, frozenset(counters), key_label)
+
+    def _stats_families(self) -> dict:
+        families = {}
+        for prefix, (stats, counters, key_label) in self._stats.items():
+            for key, value in stats().items():
+                metric_type = "counter" if key in counters else "gauge"
+                name = f"{prefix}_{key}" + ("_total" if key in counters else "")
+                if isinstance(value, str):
+                    samples = [({"state": value}, 1)]
+                elif isinstance(value, dict):
+                    samples = [({key_label: k}, v) for k, v in value.items()]
+                else:
+                    samples = [({}, value)]
+                family = families.setdefault(name, (metric_type, []))
+                family[1].extend((name, labels, v) for labels, v in samples)
+        return families
+
+    def render(self) -> str:
+        lines = []
+        families = {
+            name: (metric.type, metric.documentation, list(metric.samples()))
+            for name, metric in self._metrics.items()
+        }
+        for name, (metric_type, samples) in self._stats_families().items():
+            families.setdefault(name, (metric_type, "", samples))
+        for name, (metric_type, documentation, samples) in sorted(families.items()):
+            if documentation:
+                lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(_format_sample(*sample) for sample in samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def metrics_server(
+    host: str, port: int, metrics: MetricsRegistry = registry
+) -> HTTPServer:
+    """HTTP server answering GET /metrics with the registry's metrics."""
+
+    async def handle(method: str, path: str, headers: dict, body: bytes):
+        if path.split("?", 1)[0] != "/metrics":
+            return 404, "text/plain", b""
+        if method != "GET":
+            return 405, "text/plain", b""
+        return 200, CONTENT_TYPE, metrics.render().encode()
+
+    return HTTPServer(handle, host, port)
@@ -0,0 +1,226 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+
+from google.api_core import exceptions as api_exceptions
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+TRANSIENT_ERRORS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.ServerError,
+    api_exceptions.Aborted,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the upstream while the circuit is open."""
+
+
+def is_transient(e: Exception) -> bool:
+    """Whether an error is worth retrying: rate limits, 5xx, timeouts and
+    dropped connections. Invalid or blocked requests fail the same way again."""
+    return isinstance(e, TRANSIENT_ERRORS)
+
+
+class CircuitBreaker:
+    """Fails fast after failure_threshold consecutive transient failures and lets
+    calls through again after reset_timeout seconds. The first result after that
+    closes the circuit or opens it for another reset_timeout."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def check(self) -> None:
+        if self.failure_threshold > 0 and self.state == "open":
+            raise CircuitOpenError("Gemini is unavailable, not sending requests")
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("Circuit closed, Gemini is available again")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == "half-open" or (
+            self.opened_at is None and self.failures >= self.failure_threshold > 0
+        ):
+            logger.warning(f"Circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Latencies of the last size successful calls, for percentile estimates."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20) -> None:
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        """The q-th quantile (0..1), None until there are enough samples."""
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def hedged(
+    call: Callable[[], Awaitable[T]],
+    hedge_call: Callable[[], Awaitable[T]],
+    delay: float,
+) -> tuple[T, bool]:
+    """Runs call and, if it hasn't finished after delay seconds, hedge_call next to
+    it. Returns the first successful result and whether it came from the hedge;
+    the slower call is cancelled."""
+    first = asyncio.ensure_future(call())
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return first.result(), False
+
+        second = asyncio.ensure_future(hedge_call())
+        tasks.append(second)
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), task is second
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+class RetryPolicy:
+    """Retries transient errors up to max_attempts with capped exponential backoff
+    and full jitter, optionally hedging calls that run longer than the p95 latency,
+    behind a circuit breaker. timeout is the limit callers put on one upstream call,
+    so time spent waiting for a scheduler slot doesn't count as a failure."""
+
+    def __init__(
+        self,
+        breaker: CircuitBreaker,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        timeout: float | None = None,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+    ) -> None:
+        self.breaker = breaker
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout or None
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.errors = {}
+
+    def backoff(self, attempt: int) -> float:
+        """Delay before retry number attempt (0-based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def record_error(self, e: Exception) -> bool:
+        """Feeds an error to the circuit breaker and returns whether it's transient."""
+        name = type(e).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+        if is_transient(e):
+            self.breaker.record_failure()
+            return True
+        if isinstance(e, api_exceptions.GoogleAPICallError):
+            # The upstream answered, the request itself was the problem.
+            self.breaker.record_success()
+        return False
+
+    async def retry_or_raise(self, e: Exception, attempt: int, operation: str) -> None:
+        """Waits before the next attempt, or raises e when it shouldn't be retried."""
+        if not self.record_error(e) or attempt + 1 >= self.max_attempts:
+            raise e
+        delay = self.backoff(attempt)
+        self.retries += 1
+        logger.warning(f"Failed to {operation}: {e!r}, retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    async def _attempt(
+        self,
+        call: Callable[[], Awaitable[T]],
+        hedge_call: Callable[[], Awaitable[T]] | None,
+        latency: LatencyTracker | None,
+    ) -> T:
+        delay = None
+        if self.hedge and hedge_call and latency:
+            delay = latency.percentile(self.hedge_quantile)
+        if delay is None:
+            return await call()
+
+        def start_hedge() -> Awaitable[T]:
+            self.hedges += 1
+            return hedge_call()
+
+        result, from_hedge = await hedged(call, start_hedge, delay)
+        self.hedge_wins += from_hedge
+        return result
+
+    async def call(
+        self,
+        call: Callable[[], Awaitable[T]],
+        operation: str,
+        hedge_call: Callable[[], Awaitable[T]] | None = None,
+        latency: LatencyTracker | None = None,
+    ) -> T:
+        """Calls call until it succeeds, the error isn't transient or the attempts
+        run out. hedge_call starts the same request again without side effects
+        such as user notifications, and latency holds the upstream durations the
+        calls record; hedging needs both."""
+        for attempt in range(self.max_attempts):
+            self.breaker.check()
+            try:
+                result = await self._attempt(call, hedge_call, latency)
+            except Exception as e:
+                await self.retry_or_raise(e, attempt, operation)
+                continue
+
+            self.breaker.record_success()
+            return result
+
+    def stats(self) -> dict:
+        return {
+            "circuit": self.breaker.state,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "errors": dict(self.errors),
+        }
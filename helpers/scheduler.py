@@ -0,0 +1,202 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when a request can't be queued because the queues are full."""
+
+
+class TokenBucket:
+    """Rate limit of amount per minute with bursts up to burst (default: a minute's
+    worth); a non-positive rate means unlimited."""
+
+    def __init__(self, per_minute: float, burst: float | None = None) -> None:
+        self.capacity = burst or per_minute
+        self.rate = per_minute / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be consumed, 0 when it can be consumed now."""
+        if self.rate <= 0:
+            return 0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        """Takes amount from the bucket, negative amounts give tokens back."""
+        if self.rate <= 0:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ScheduledRequest:
+    __slots__ = ("user_id", "tokens", "future")
+
+    def __init__(self, user_id, tokens: int) -> None:
+        self.user_id = user_id
+        self.tokens = tokens
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class GeminiScheduler:
+    """Admits outbound Gemini calls within requests-per-minute and tokens-per-minute
+    budgets and a global concurrency cap. Waiting requests are queued per user and
+    served round-robin, so one heavy user can't starve the others.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        max_concurrency: int,
+        max_queue_per_user: int,
+        max_queue: int,
+    ) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_queue_per_user = max_queue_per_user
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._queues: dict[object, deque[ScheduledRequest]] = {}
+        self._order = deque()
+        self._timer = None
+
+    def queue_position(self, request: ScheduledRequest) -> int:
+        """Estimated 1-based position of a waiting request under round-robin."""
+        queue = self._queues.get(request.user_id)
+        if not queue or request not in queue:
+            return 0
+        rounds = queue.index(request) + 1
+        return sum(min(len(other), rounds) for other in self._queues.values())
+
+    def _schedule_dispatch(self, delay: float) -> None:
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._order and self.in_flight < self.max_concurrency:
+            user_id = self._order[0]
+            request = self._queues[user_id][0]
+            delay = max(
+                self.requests.wait_time(1), self.tokens.wait_time(request.tokens)
+            )
+            if delay > 0:
+                self._schedule_dispatch(delay)
+                return
+
+            self._order.popleft()
+            queue = self._queues[user_id]
+            queue.popleft()
+            if queue:
+                self._order.append(user_id)
+            else:
+                del self._queues[user_id]
+
+            self.waiting -= 1
+            self.in_flight += 1
+            self.requests.consume(1)
+            self.tokens.consume(request.tokens)
+            request.future.set_result(None)
+
+    def _remove(self, request: ScheduledRequest) -> None:
+        queue = self._queues.get(request.user_id)
+        if queue and request in queue:
+            queue.remove(request)
+            self.waiting -= 1
+            if not queue:
+                del self._queues[request.user_id]
+                self._order.remove(request.user_id)
+
+    def _release(self, request: ScheduledRequest) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    async def _acquire(
+        self,
+        user_id,
+        tokens: int,
+        on_queued: Callable[[int], Awaitable[None]] | None,
+    ) -> ScheduledRequest:
+        queue = self._queues.get(user_id)
+        if self.waiting >= self.max_queue or (
+            queue and len(queue) >= self.max_queue_per_user
+        ):
+            self.rejected += 1
+            raise QueueFullError("Too many requests are waiting for Gemini")
+
+        request = ScheduledRequest(user_id, tokens)
+        if queue is None:
+            self._queues[user_id] = queue = deque()
+            self._order.append(user_id)
+        queue.append(request)
+        self.waiting += 1
+        self._dispatch()
+
+        try:
+            if not request.future.done() and on_queued:
+                try:
+                    await on_queued(self.queue_position(request))
+                except Exception as e:
+                    logger.warning("Failed to report queue position: %s", e)
+            await request.future
+        except asyncio.CancelledError:
+            if request.future.done() and not request.future.cancelled():
+                self._release(request)
+            else:
+                self._remove(request)
+            raise
+
+        return request
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        user_id,
+        tokens: int,
+        on_queued: Callable[[int], Awaitable[None]] | None = None,
+    ):
+        """Waits for the user's turn and holds a concurrency slot while the call runs.
+        on_queued is awaited with the queue position when the request has to wait.
+        """
+        request = await self._acquire(user_id, tokens, on_queued)
+        try:
+            yield request
+        finally:
+            self._release(request)
+
+    def record_usage(self, request: ScheduledRequest, tokens: int) -> None:
+        """Corrects the tokens-per-minute budget with the real usage of a request."""
+        self.tokens.consume(tokens - request.tokens)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "max_concurrency": self.max_concurrency,
+            "requests_per_minute": self.requests.rate * 60,
+        }
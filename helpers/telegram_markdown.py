@@ -0,0 +1,313 @@
+"""Single-pass conversion of the Markdown Gemini writes into Telegram message
+entities.
+
+The result is plain text plus a list of MessageEntity, so nothing has to be
+escaped and a malformed reply (an unclosed ``**``, a stray ``_`` in a file name)
+simply stays literal text instead of making Telegram reject the whole message.
+Entities are always properly nested and never put inside code, as the Bot API
+requires.
+"""
+
+import re
+
+from telegram import MessageEntity
+from telegram.constants import MessageLimit
+
+
+FENCE = re.compile(r"^\s*(`{3,}|~{3,})\s*([\w#+.-]*)")
+HEADING = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)[\s#]*$")
+BULLET = re.compile(r"^(\s*)[*+-]\s+")
+RULE = re.compile(r"^\s{0,3}([-*_])(\s*\1){2,}\s*$")
+QUOTE = re.compile(r"^\s{0,3}>\s?")
+TABLE_ROW = re.compile(r"^\s*\|")
+LINK = re.compile(r"\[([^\]\n]+)\]\((https?://[^\s)]+)\)")
+SPECIAL = re.compile(r"[\\`*_~\[]")
+ESCAPABLE = set("\\`*_{}[]()#+-.!|~>")
+
+BULLET_SIGN = "• "
+RULE_TEXT = "――――――――"
+
+
+class _Renderer:
+    def __init__(self) -> None:
+        self.parts = []
+        self.length = 0
+        # (type, start, length, extra) in Python string indices.
+        self.entities = []
+
+    def text(self, text: str) -> None:
+        if text:
+            self.parts.append(text)
+            self.length += len(text)
+
+    def entity(self, entity_type: str, start: int, **extra) -> None:
+        if self.length > start:
+            self.entities.append((entity_type, start, self.length - start, extra))
+
+
+def _is_word(text: str, index: int) -> bool:
+    return 0 <= index < len(text) and text[index].isalnum()
+
+
+def _find_closer(text: str, delimiter: str, start: int) -> int:
+    """Index of the delimiter closing an emphasis opened before start, -1 if none.
+    A single * or _ doesn't close on a doubled one, so bold can nest in italic."""
+    size = len(delimiter)
+    index = text.find(delimiter, start)
+    while index != -1:
+        if size == 2:
+            # "***" closes bold after the italic: use the last two of the run.
+            while text[index + size : index + size + 1] == delimiter[0]:
+                index += 1
+        if not text[index - 1].isspace() and index > start:
+            if size == 2 or (
+                text[index + 1 : index + 2] != delimiter
+                and text[index - 1] != delimiter
+            ):
+                if delimiter[0] != "_" or not _is_word(text, index + size):
+                    return index
+        index = text.find(delimiter, index + size)
+    return -1
+
+
+def _render_inline(renderer: _Renderer, text: str, active: frozenset) -> None:
+    pos = 0
+    scan = 0
+    length = len(text)
+    while True:
+        match = SPECIAL.search(text, scan)
+        if match is None:
+            renderer.text(text[pos:])
+            return
+
+        i = match.start()
+        char = text[i]
+        end = None
+
+        if char == "\\":
+            if i + 1 < length and text[i + 1] in ESCAPABLE:
+                renderer.text(text[pos:i])
+                renderer.text(text[i + 1])
+                end = i + 2
+
+        elif char == "`":
+            run = i
+            while run < length and text[run] == "`":
+                run += 1
+            ticks = run - i
+            close = text.find("`" * ticks, run)
+            if close != -1 and text[run:close].strip():
+                code = text[run:close]
+                if ticks > 1 and code.startswith(" ") and code.endswith(" "):
+                    code = code[1:-1]
+                renderer.text(text[pos:i])
+                start = renderer.length
+                renderer.text(code)
+                if not active:
+                    renderer.entity(MessageEntity.CODE, start)
+                end = close + ticks
+            else:
+                scan = run
+                continue
+
+        elif char == "[":
+            link = LINK.match(text, i)
+            if link and "link" not in active:
+                renderer.text(text[pos:i])
+                start = renderer.length
+                _render_inline(renderer, link.group(1), active | {"link"})
+                renderer.entity(MessageEntity.TEXT_LINK, start, url=link.group(2))
+                end = link.end()
+
+        else:
+            double = text[i : i + 2] == char * 2
+            if char == "~":
+                kind, delimiter = MessageEntity.STRIKETHROUGH, "~~"
+            elif double:
+                kind, delimiter = MessageEntity.BOLD, char * 2
+            else:
+                kind, delimiter = MessageEntity.ITALIC, char
+            opens = (
+                (char != "~" or double)
+                and kind not in active
+                and i + len(delimiter) < length
+                and not text[i + len(delimiter)].isspace()
+                and (char != "_" or not _is_word(text, i - 1))
+            )
+            if opens:
+                close = _find_closer(text, delimiter, i + len(delimiter))
+                if close != -1:
+                    renderer.text(text[pos:i])
+                    start = renderer.length
+                    _render_inline(
+                        renderer, text[i + len(delimiter) : close], active | {kind}
+                    )
+                    renderer.entity(kind, start)
+                    end = close + len(delimiter)
+            if end is None:
+                # Skip the whole run so "**" that doesn't open isn't retried as "*".
+                run = i
+                while run < length and text[run] == char:
+                    run += 1
+                scan = run
+                continue
+
+        if end is None:
+            scan = i + 1
+        else:
+            pos = scan = end
+
+
+def _utf16_offsets(text: str):
+    """Maps Python string indices to the UTF-16 offsets Telegram counts in."""
+    if all(ord(char) <= 0xFFFF for char in text):
+        return lambda index: index
+    prefix = [0]
+    for char in text:
+        prefix.append(prefix[-1] + (2 if ord(char) > 0xFFFF else 1))
+    return prefix.__getitem__
+
+
+def _render(md: str) -> _Renderer:
+    renderer = _Renderer()
+    lines = md.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if i:
+            renderer.text("\n")
+
+        fence = FENCE.match(line)
+        if fence:
+            marker = fence.group(1)
+            end = i + 1
+            while end < len(lines) and not lines[end].strip().startswith(marker):
+                end += 1
+            start = renderer.length
+            renderer.text("\n".join(lines[i + 1 : end]))
+            renderer.entity(MessageEntity.PRE, start, language=fence.group(2) or None)
+            i = end + 1
+            continue
+
+        if TABLE_ROW.match(line):
+            end = i + 1
+            while end < len(lines) and TABLE_ROW.match(lines[end]):
+                end += 1
+            start = renderer.length
+            renderer.text("\n".join(row.strip() for row in lines[i:end]))
+            renderer.entity(MessageEntity.PRE, start)
+            i = end
+            continue
+
+        if QUOTE.match(line):
+            start = renderer.length
+            end = i
+            while end < len(lines) and QUOTE.match(lines[end]):
+                if end > i:
+                    renderer.text("\n")
+                quoted = QUOTE.sub("", lines[end], count=1)
+                _render_inline(renderer, quoted, frozenset({"blockquote"}))
+                end += 1
+            renderer.entity(MessageEntity.BLOCKQUOTE, start)
+            i = end
+            continue
+
+        heading = HEADING.match(line)
+        bullet = BULLET.match(line)
+        if heading:
+            start = renderer.length
+            _render_inline(renderer, heading.group(1), frozenset({MessageEntity.BOLD}))
+            renderer.entity(MessageEntity.BOLD, start)
+        elif RULE.match(line):
+            renderer.text(RULE_TEXT)
+        elif bullet:
+            renderer.text(bullet.group(1) + BULLET_SIGN)
+            _render_inline(renderer, line[bullet.end() :], frozenset())
+        else:
+            _render_inline(renderer, line, frozenset())
+        i += 1
+
+    return renderer
+
+
+def _message(
+    text: str, raw_entities: list, start: int, end: int
+) -> tuple[str, list[MessageEntity]]:
+    """Text of text[start:end] as Telegram will keep it, with the entities clipped
+    to it and converted to UTF-16 offsets."""
+    chunk = text[start:end]
+    # Telegram trims the message, keep the entities aligned with what's left.
+    stripped = chunk.strip()
+    lead = start + len(chunk) - len(chunk.lstrip())
+    utf16 = _utf16_offsets(stripped)
+    entities = []
+    for entity_type, offset, length, extra in sorted(
+        raw_entities, key=lambda e: (e[1], -e[2])
+    ):
+        begin = max(offset - lead, 0)
+        finish = min(offset + length - lead, len(stripped))
+        if finish > begin and stripped[begin:finish].strip():
+            entities.append(
+                MessageEntity(
+                    entity_type, utf16(begin), utf16(finish) - utf16(begin), **extra
+                )
+            )
+    return stripped, entities
+
+
+def render_markdown(md: str) -> tuple[str, list[MessageEntity]]:
+    """Converts Markdown to plain text and the entities that format it."""
+    renderer = _render(md)
+    text = "".join(renderer.parts)
+    return _message(text, renderer.entities, 0, len(text))
+
+
+def _split_point(text: str, start: int, end: int, code_blocks: list) -> int:
+    """Where to end a chunk that may not go past end: after a paragraph outside
+    code blocks, then after a line outside them, a line inside them, a word, and
+    only then in the middle of a word."""
+    if end >= len(text):
+        return len(text)
+
+    def in_code(index: int) -> bool:
+        return any(s < index < e for s, e in code_blocks)
+
+    # Don't make chunks much shorter than needed just to split nicely.
+    lowest = start + (end - start) // 2
+    for separator, outside_code in (("\n\n", True), ("\n", True), ("\n", False)):
+        index = text.rfind(separator, lowest, end)
+        while index > lowest and outside_code and in_code(index):
+            index = text.rfind(separator, lowest, index)
+        if index > lowest:
+            return index
+    index = text.rfind(" ", lowest, end)
+    return index if index > lowest else end
+
+
+def split_markdown(
+    md: str, limit: int = MessageLimit.MAX_TEXT_LENGTH
+) -> list[tuple[str, list[MessageEntity]]]:
+    """Renders Markdown like render_markdown and splits the result into messages of
+    at most limit UTF-16 units, preferably at paragraph and code block boundaries.
+    Entities crossing a split continue in the next message."""
+    renderer = _render(md)
+    text = "".join(renderer.parts)
+    code_blocks = [
+        (start, start + length)
+        for entity_type, start, length, _ in renderer.entities
+        if entity_type == MessageEntity.PRE
+    ]
+    utf16 = _utf16_offsets(text)
+
+    messages = []
+    start = 0
+    while start < len(text):
+        end = min(start + limit, len(text))
+        while utf16(end) - utf16(start) > limit:
+            end -= 1
+        end = _split_point(text, start, end, code_blocks)
+        message = _message(text, renderer.entities, start, end)
+        if message[0]:
+            messages.append(message)
+        start = end
+    return messages
@@ -0,0 +1,162 @@
+"""Per-user accounting of Gemini requests and tokens, with daily and monthly quotas.
+
+Usage is added up in memory per user and UTC day and written to the database in
+batches, as increments so processes sharing the database don't overwrite each
+other. Quotas are checked before each request from the in-memory totals; calls
+that are already running when a quota is reached still finish and are counted.
+"""
+
+import time
+import asyncio
+import logging
+
+from database.database import select_usage_since, add_usage_batch
+
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceededError(Exception):
+    """Raised instead of calling Gemini when a user has used up a quota."""
+
+
+def current_day() -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+class UsageTracker:
+    """Counts requests and tokens per user and enforces limits per UTC day and
+    calendar month; a limit of 0 means unlimited. Set db to persist the usage."""
+
+    def __init__(
+        self,
+        daily_requests: int = 0,
+        daily_tokens: int = 0,
+        monthly_requests: int = 0,
+        monthly_tokens: int = 0,
+        flush_interval: float = 10.0,
+    ) -> None:
+        self.limits = {
+            "daily": (daily_requests, daily_tokens),
+            "monthly": (monthly_requests, monthly_tokens),
+        }
+        self.flush_interval = flush_interval
+        self.db = None
+        self.rejected = 0
+        # user id -> [period, requests, tokens]
+        self._daily = {}
+        self._monthly = {}
+        # (user id, day) -> [requests, prompt tokens, response tokens] not yet written
+        self._pending = {}
+        self._flush_task = None
+
+    def _totals(self, totals: dict, user_id: int, period: str) -> list:
+        entry = totals.get(user_id)
+        if entry is None or entry[0] != period:
+            entry = totals[user_id] = [period, 0, 0]
+        return entry
+
+    def _add(
+        self, totals: dict, user_id: int, period: str, requests: int, tokens: int
+    ) -> None:
+        entry = self._totals(totals, user_id, period)
+        entry[1] += requests
+        entry[2] += tokens
+
+    async def load(self) -> None:
+        """Reads the usage of the current month from the database."""
+        if self.db is None:
+            return
+        day = current_day()
+        rows = await self.db.run(select_usage_since, day[:7] + "-01")
+        for user_id, row_day, requests, prompt_tokens, response_tokens in rows:
+            tokens = prompt_tokens + response_tokens
+            self._add(self._monthly, user_id, day[:7], requests, tokens)
+            if row_day == day:
+                self._add(self._daily, user_id, day, requests, tokens)
+        logger.info(f"Loaded this month's Gemini usage of {len(self._monthly)} users")
+
+    def usage(self, user_id: int) -> dict:
+        """Requests and tokens of the user today and this month."""
+        day = current_day()
+        daily = self._totals(self._daily, user_id, day)
+        monthly = self._totals(self._monthly, user_id, day[:7])
+        return {
+            "daily": {"requests": daily[1], "tokens": daily[2]},
+            "monthly": {"requests": monthly[1], "tokens": monthly[2]},
+        }
+
+    def check(self, user_id: int | None, tokens: int = 0) -> None:
+        """Raises QuotaExceededError when another request of about tokens would go
+        over one of the user's limits."""
+        if user_id is None:
+            return
+        for period, used in self.usage(user_id).items():
+            max_requests, max_tokens = self.limits[period]
+            if max_requests and used["requests"] >= max_requests:
+                limit = f"{max_requests} requests"
+            elif max_tokens and used["tokens"] + tokens > max_tokens:
+                limit = f"{max_tokens} tokens"
+            else:
+                continue
+            self.rejected += 1
+            resets = "at midnight UTC" if period == "daily" else "next month"
+            raise QuotaExceededError(
+                f"You have used up your {period} quota of {limit}. It resets {resets}."
+            )
+
+    def record(
+        self, user_id: int | None, prompt_tokens: int, response_tokens: int
+    ) -> None:
+        """Counts a finished request of the user."""
+        if user_id is None:
+            return
+        day = current_day()
+        tokens = prompt_tokens + response_tokens
+        self._add(self._daily, user_id, day, 1, tokens)
+        self._add(self._monthly, user_id, day[:7], 1, tokens)
+        pending = self._pending.setdefault((user_id, day), [0, 0, 0])
+        pending[0] += 1
+        pending[1] += prompt_tokens
+        pending[2] += response_tokens
+        if self.db is not None:
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self._write()
+
+    async def _write(self) -> None:
+        if not self._pending or self.db is None:
+            return
+        pending, self._pending = self._pending, {}
+        rows = [(*key, *values) for key, values in pending.items()]
+        try:
+            await self.db.run(add_usage_batch, rows)
+            logger.debug(f"Persisted Gemini usage of {len(rows)} users")
+        except Exception as e:
+            logger.error(f"Failed to persist Gemini usage: {e}")
+            # Keep the increments for the next run.
+            for key, values in pending.items():
+                merged = self._pending.setdefault(key, [0, 0, 0])
+                for i, value in enumerate(values):
+                    merged[i] += value
+
+    async def flush(self) -> None:
+        """Writes the pending usage now."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write()
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._daily),
+            "pending": len(self._pending),
+            "rejected": self.rejected,
+        }
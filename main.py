@@ -1,6 +1,12 @@
 import os
+import time
+import signal
 import logging
 from dotenv import load_dotenv
+
+# Before the project imports, which read their settings from the environment.
+load_dotenv()
+
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -10,7 +16,16 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-from database.database import create_connection, create_table
+from core import model_registry, usage_tracker
+from helpers.metrics import registry
+from database.database import create_table, delete_expired_responses
+from database.async_database import AsyncDatabase
+from bot.update_processor import PerUserUpdateProcessor, UpdateQueue
+from bot.webhook import run_webhook
+from bot.persistence import SQLitePersistence
+from bot.sharding import ShardedWorkers
+from bot.metrics import MeasuredRequest, start_metrics_server, stop_metrics_server
+from bot.access import allow_list
 from bot.conversation_handlers import (
     start,
     start_over,
@@ -18,14 +33,15 @@ from bot.conversation_handlers import (
     reply_and_new_message,
     start_image_conversation,
     generate_text_from_image,
+    start_batch,
+    generate_batch_from_file,
     get_conversation_history,
     get_conversation_handler,
     delete_conversation_handler,
     done,
+    response_cache,
 )
 
-load_dotenv()
-
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
@@ -33,14 +49,22 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
-CHOOSING, IMAGE_CHOICE, CONVERSATION, CONVERSATION_HISTORY = range(4)
+CHOOSING, IMAGE_CHOICE, CONVERSATION, CONVERSATION_HISTORY, BATCH = range(5)
+
+# Only the update types the handlers below consume.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+DATABASE_FILE = os.getenv("DATABASE_FILE", "./conversations_data.db")
+# With more than one, updates are handled by that many worker processes.
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
 
 
 def entry_points():
     return [
         CommandHandler("start", lambda update, context: start(update, context)),
+        CommandHandler("batch", lambda update, context: start_batch(update, context)),
         CallbackQueryHandler(
-            lambda update, context: start_over(update, context, conn),
+            lambda update, context: start_over(update, context, db),
             pattern="^Start_Again",
         ),
     ]
@@ -58,7 +82,7 @@ def states():
                 pattern="^Image_Description$",
             ),
             CallbackQueryHandler(
-                lambda update, context: get_conversation_history(update, context, conn),
+                lambda update, context: get_conversation_history(update, context, db),
                 pattern="^PAGE#",
             ),
             CallbackQueryHandler(
@@ -75,21 +99,27 @@ def states():
         CONVERSATION: [
             MessageHandler(
                 filters.TEXT & ~filters.Regex("^/"),
-                lambda update, context: reply_and_new_message(update, context),
+                lambda update, context: reply_and_new_message(update, context, db),
+            )
+        ],
+        BATCH: [
+            MessageHandler(
+                filters.Document.ALL,
+                lambda update, context: generate_batch_from_file(update, context),
             )
         ],
         CONVERSATION_HISTORY: [
             CallbackQueryHandler(
-                lambda update, context: get_conversation_history(update, context, conn),
+                lambda update, context: get_conversation_history(update, context, db),
                 pattern="^PAGE#",
             ),
             MessageHandler(
                 filters.Regex("^/conv"),
-                lambda update, context: get_conversation_handler(update, context, conn),
+                lambda update, context: get_conversation_handler(update, context, db),
             ),
             CallbackQueryHandler(
                 lambda update, context: delete_conversation_handler(
-                    update, context, conn
+                    update, context, db
                 ),
                 pattern="^Delete_Conversation$",
             ),
@@ -99,11 +129,12 @@ def states():
 
 def fallbacks():
     return [
+        CommandHandler("batch", lambda update, context: start_batch(update, context)),
         CallbackQueryHandler(
             lambda update, context: done(update, context), pattern="^Done$"
         ),
         CallbackQueryHandler(
-            lambda update, context: start_over(update, context, conn),
+            lambda update, context: start_over(update, context, db),
             pattern="^Start_Again",
         ),
     ]
@@ -111,23 +142,124 @@ def fallbacks():
 
 def create_conv_handler():
     return ConversationHandler(
-        entry_points=entry_points(), states=states(), fallbacks=fallbacks()
+        entry_points=entry_points(),
+        states=states(),
+        fallbacks=fallbacks(),
+        name="conversation",
+        persistent=True,
     )
 
 
+async def post_init(application: Application) -> None:
+    await start_metrics_server(application)
+    await db.run(create_table)
+    if os.getenv("RESPONSE_CACHE_PERSISTENT", "false").lower() in ("1", "true", "yes"):
+        response_cache.db = db
+        await db.run(delete_expired_responses, time.time() - response_cache.ttl)
+    usage_tracker.db = db
+    await usage_tracker.load()
+
+
+async def post_shutdown(application: Application) -> None:
+    await stop_metrics_server(application)
+    await usage_tracker.flush()
+    db.close()
+
+
+def application_builder():
+    builder = (
+        Application.builder()
+        .token(os.getenv("TELEGRAM_BOT_TOKEN"))
+        .request(MeasuredRequest(connection_pool_size=256))
+    )
+    if os.getenv("TELEGRAM_API_BASE_URL"):
+        api_base_url = os.getenv("TELEGRAM_API_BASE_URL").rstrip("/")
+        builder = builder.base_url(f"{api_base_url}/bot").base_file_url(
+            f"{api_base_url}/file/bot"
+        )
+    return builder
+
+
+def build_application(shard: tuple[int, int] | None = None) -> Application:
+    max_concurrent_updates = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+    application = (
+        application_builder()
+        .update_queue(UpdateQueue(maxsize=int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))))
+        .concurrent_updates(PerUserUpdateProcessor(max_concurrent_updates))
+        .persistence(SQLitePersistence(db, shard=shard))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    application.add_handler(create_conv_handler())
+
+    return application
+
+
+def build_intake_application(workers: ShardedWorkers) -> Application:
+    """Receives updates and only forwards them to the worker processes."""
+    application = (
+        application_builder()
+        .post_init(start_metrics_server)
+        .post_shutdown(stop_metrics_server)
+        .build()
+    )
+    application.add_handler(workers.handler())
+    registry.add_stats(
+        "shard", workers.stats, counters=["forwarded"], key_label="shard"
+    )
+    return application
+
+
+def reload_settings() -> None:
+    """Re-reads the settings that can change without a restart."""
+    model_registry.reload_safety_settings()
+    allow_list.reload()
+
+
 def main() -> None:
-    application = Application.builder().token(os.getenv("TELEGRAM_BOT_TOKEN")).build()
+    workers = None
+    if WORKER_PROCESSES > 1:
+        workers = ShardedWorkers(WORKER_PROCESSES, DATABASE_FILE)
+        workers.start()
+        application = build_intake_application(workers)
+    else:
+        application = build_application()
 
-    conv_handler = create_conv_handler()
-    application.add_handler(conv_handler)
+    def on_sighup(signum, frame):
+        reload_settings()
+        if workers is not None:
+            workers.send_signal(signum)
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    model_registry.reload_safety_settings()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, on_sighup)
 
+    try:
+        serve(application)
+    finally:
+        if workers is not None:
+            workers.stop()
 
-if __name__ == "__main__":
-    database = "./conversations_data.db"
 
-    conn = create_connection(database)
-    create_table(conn)
+def serve(application: Application) -> None:
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        run_webhook(
+            application,
+            webhook_url=webhook_url,
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+            url_path=os.getenv("WEBHOOK_PATH", "/telegram"),
+            secret_token=os.getenv("WEBHOOK_SECRET_TOKEN"),
+            max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")),
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+
+if __name__ == "__main__":
+    db = AsyncDatabase(DATABASE_FILE, max_workers=int(os.getenv("DB_WORKERS", "2")))
 
     main()
@@ -0,0 +1,251 @@
+"""In-process fake of the Telegram Bot API for local end-to-end runs.
+
+Point the bot at it with TELEGRAM_API_BASE_URL=<fake.base_url>. It records every
+call, answers the methods the bot uses with plausible results, serves getUpdates
+from updates pushed with push_update and serves file downloads with file_data.
+"""
+
+import json
+import time
+import email
+import random
+import asyncio
+import itertools
+from urllib.parse import parse_qsl, unquote
+from typing import Callable
+
+from helpers.http_server import HTTPServer
+
+
+BOT_USER = {
+    "id": 1000,
+    "is_bot": True,
+    "first_name": "GeminiBot",
+    "username": "gemini_test_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+
+def _decode_value(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_params(headers: dict, body: bytes) -> dict:
+    """Parses Bot API parameters sent as urlencoded form, multipart or JSON."""
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        message = email.message_from_bytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        params = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                params[name] = part.get_payload(decode=True)
+            else:
+                params[name] = _decode_value(part.get_payload(decode=True).decode())
+        return params
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    return {k: _decode_value(v) for k, v in parse_qsl(body.decode())}
+
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        token: str,
+        file_data: bytes = b"",
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: Callable[[], float] | None = None,
+    ) -> None:
+        self.token = token
+        self.file_data = file_data
+        self.latency = latency
+        self.calls = []
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_update = asyncio.Event()
+        self._call_waiters = []
+        self.server = HTTPServer(self._handle, host, port)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.server.host}:{self.server.port}"
+
+    async def start(self) -> None:
+        await self.server.start()
+
+    async def stop(self) -> None:
+        await self.server.stop()
+
+    def calls_of(self, method: str) -> list[dict]:
+        return [params for name, params in self.calls if name == method]
+
+    async def wait_for_call(
+        self, predicate: Callable[[str, dict], bool], start: int = 0, timeout=30.0
+    ) -> tuple[str, dict]:
+        """Returns the first call from index start on that satisfies
+        predicate(method, params), waiting until one is answered if there is none."""
+        for call in self.calls[start:]:
+            if predicate(*call):
+                return call
+        waiter = (predicate, asyncio.get_running_loop().create_future())
+        self._call_waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter[1], timeout)
+        finally:
+            self._call_waiters.remove(waiter)
+
+    def push_update(self, update: dict) -> dict:
+        """Queues an update for getUpdates and returns it with its update_id."""
+        update = {"update_id": next(self._update_ids), **update}
+        self._updates.append(update)
+        self._new_update.set()
+        return update
+
+    def _message(self, chat_id, **fields) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        offset = params.get("offset", 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(
+                    self._new_update.wait(), min(params.get("timeout", 0), 1) or 0.01
+                )
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[: params.get("limit", 100)]
+
+    async def _result(self, method: str, params: dict):
+        chat_id = params.get("chat_id", 0)
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "sendMessage":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method in ("sendDocument", "sendAnimation", "sendPhoto"):
+            return self._message(chat_id, caption=params.get("caption", ""))
+        if method == "editMessageText":
+            return {
+                **self._message(chat_id, text=params.get("text", "")),
+                "message_id": params.get("message_id", 0),
+            }
+        if method == "getFile":
+            return {
+                "file_id": params["file_id"],
+                "file_unique_id": f"u{params['file_id']}",
+                "file_size": len(self.file_data),
+                "file_path": f"files/{params['file_id']}",
+            }
+        return True
+
+    async def _handle(
+        self, method: str, path: str, headers: dict, body: bytes
+    ) -> tuple[int, str, bytes]:
+        # File downloads quote the ':' of the token.
+        path = unquote(path)
+        if path.startswith(f"/file/bot{self.token}/"):
+            return 200, "application/octet-stream", self.file_data
+
+        prefix = f"/bot{self.token}/"
+        if not path.startswith(prefix):
+            return 404, "application/json", b'{"ok": false}'
+
+        api_method = path[len(prefix) :]
+        params = parse_params(headers, body)
+        self.calls.append((api_method, params))
+        if self.latency and api_method != "getUpdates":
+            await asyncio.sleep(self.latency())
+
+        result = await self._result(api_method, params)
+        for predicate, future in self._call_waiters:
+            if not future.done() and predicate(api_method, params):
+                future.set_result((api_method, params))
+        return (
+            200,
+            "application/json",
+            json.dumps({"ok": True, "result": result}).encode(),
+        )
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def message_update(user_id: int, text: str | None = None, **fields) -> dict:
+    """Builds a private message update; text starting with / becomes a command."""
+    message = {
+        "message_id": random.randint(1, 2**31),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        **fields,
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+            ]
+    return {"message": message}
+
+
+def photo_message_update(
+    user_id: int,
+    caption: str | None = None,
+    media_group_id: str | None = None,
+    width: int = 1280,
+    height: int = 960,
+) -> dict:
+    photo_id = f"photo{random.randint(1, 2**31)}"
+    fields = {
+        "photo": [
+            {
+                "file_id": f"{photo_id}_{w}",
+                "file_unique_id": f"{photo_id}_{w}",
+                "width": w,
+                "height": h,
+            }
+            for w, h in ((width // 4, height // 4), (width, height))
+        ]
+    }
+    if caption:
+        fields["caption"] = caption
+    if media_group_id:
+        fields["media_group_id"] = media_group_id
+    return message_update(user_id, **fields)
+
+
+def callback_update(user_id: int, data: str, message_id: int = 1) -> dict:
+    return {
+        "callback_query": {
+            "id": str(random.randint(1, 2**31)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "menu",
+            },
+        }
+    }
@@ -0,0 +1,149 @@
+"""In-process fake of the Gemini models for local load tests.
+
+FakeGemini.install() makes the model registry hand out fake models, so the bot
+runs unchanged without network access or quota. Responses arrive in chunks: the
+first one after a time to first token drawn from a latency distribution, the
+others every chunk_delay seconds, like a streamed Gemini response.
+"""
+
+import math
+import random
+import asyncio
+
+import google.ai.generativelanguage as glm
+from google.api_core.exceptions import ServiceUnavailable
+
+from core import ModelRegistry
+
+
+REPLY = (
+    "Here is an overview of **{topic}**.\n\n"
+    "1. *First*, look at how it works in practice.\n"
+    "2. Then compare it with the alternatives.\n\n"
+    "```python\nprint('{topic}')\n```\n\n"
+    "More details about {topic} follow in the next paragraph. "
+)
+
+
+class Latency:
+    """Log-normal latency given by its median and 95th percentile in seconds;
+    constant when p95 isn't above the median."""
+
+    def __init__(self, median: float, p95: float | None = None) -> None:
+        self.median = median
+        p95 = p95 or median
+        self.sigma = math.log(p95 / median) / 1.645 if p95 > median > 0 else 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        """Parses "median" or "median,p95"."""
+        return cls(*(float(value) for value in spec.split(",")))
+
+    def __call__(self) -> float:
+        if not self.sigma:
+            return self.median
+        return self.median * math.exp(random.gauss(0, self.sigma))
+
+
+class FakeChunk:
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+
+class FakeResponse:
+    """Stands in for the SDK's streamed AsyncGenerateContentResponse."""
+
+    usage_metadata = None
+
+    def __init__(self, chunks: list[str], chunk_delay: float) -> None:
+        self.chunks = chunks
+        self._chunk_delay = chunk_delay
+        self._received = 1
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks[: self._received])
+
+    async def __aiter__(self):
+        yield FakeChunk(self.chunks[0])
+        for chunk in self.chunks[1:]:
+            await asyncio.sleep(self._chunk_delay)
+            self._received += 1
+            yield FakeChunk(chunk)
+
+    async def resolve(self) -> None:
+        async for _ in self:
+            pass
+
+
+class FakeChatSession:
+    def __init__(self, model: "FakeModel", history: list | None) -> None:
+        self.model = model
+        self.history = list(history or [])
+
+    async def send_message_async(self, content, stream: bool = False, **kwargs):
+        response = await self.model.generate_content_async(content, stream=stream)
+        self.history.extend(
+            [
+                glm.Content(role="user", parts=[glm.Part(text=str(content))]),
+                glm.Content(
+                    role="model", parts=[glm.Part(text="".join(response.chunks))]
+                ),
+            ]
+        )
+        return response
+
+
+class FakeModel:
+    def __init__(self, gemini: "FakeGemini", model_name: str) -> None:
+        self.gemini = gemini
+        self.model_name = model_name
+
+    def start_chat(self, history: list | None = None) -> FakeChatSession:
+        return FakeChatSession(self, history)
+
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        gemini = self.gemini
+        gemini.requests[self.model_name] = gemini.requests.get(self.model_name, 0) + 1
+        if random.random() < gemini.error_rate:
+            await asyncio.sleep(gemini.ttft())
+            raise ServiceUnavailable("Fake Gemini error")
+
+        prompt = contents if isinstance(contents, str) else str(contents[0])
+        chunks = gemini.reply_chunks(prompt)
+        await asyncio.sleep(gemini.ttft())
+        response = FakeResponse(chunks, gemini.chunk_delay)
+        if not stream:
+            await response.resolve()
+        return response
+
+
+class FakeGemini:
+    def __init__(
+        self,
+        ttft: Latency = Latency(0.5),
+        chunks: int = 8,
+        chunk_delay: float = 0.05,
+        reply_chars: int = 1200,
+        error_rate: float = 0.0,
+    ) -> None:
+        self.ttft = ttft
+        self.chunks = max(1, chunks)
+        self.chunk_delay = chunk_delay
+        self.reply_chars = reply_chars
+        self.error_rate = error_rate
+        self.requests = {}
+
+    def reply_chunks(self, prompt: str) -> list[str]:
+        topic = " ".join(prompt.split()[:3]) or "this"
+        text = REPLY.format(topic=topic)
+        text = (text * (self.reply_chars // len(text) + 1))[: self.reply_chars]
+        size = math.ceil(len(text) / self.chunks)
+        return [text[i : i + size] for i in range(0, len(text), size)]
+
+    def get_model(self, model_name: str, api_key: str, safety_settings=None):
+        return FakeModel(self, model_name)
+
+    def install(self, registry: ModelRegistry) -> None:
+        """Makes registry return fake models from now on."""
+        registry.get_model = self.get_model
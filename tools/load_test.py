@@ -0,0 +1,350 @@
+"""Load test of the bot against the fake Bot API and a fake Gemini.
+
+Run from the project root:  python -m tools.load_test [--users 20] [--journeys 2]
+The real Application from main.py handles the updates, with Gemini replaced in
+process by tools.fake_gemini. Every virtual user runs its journeys one after the
+other while all users run concurrently. A journey starts a conversation of
+--turns messages and saves it, browses the chat history, resumes the saved
+conversation for one more message, saves again and has an image described.
+
+The report shows throughput, the p50/p95/p99 time from sending an update until
+the bot answered it for each handler, and the event loop lag. Bot, fakes and
+users share one event loop, so the lag includes the fakes' own work. --output
+writes the report as JSON.
+"""
+
+import io
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+
+import PIL.Image
+
+from tools.fake_bot_api import (
+    FakeBotAPI,
+    message_update,
+    callback_update,
+    photo_message_update,
+)
+
+TOKEN = "123456:LOAD"
+FIRST_USER_ID = 10_000
+PLACEHOLDER = "Wait for response processing..."
+LAG_INTERVAL = 0.01
+
+
+class JourneyFailed(Exception):
+    pass
+
+
+def callbacks(params: dict) -> list[str]:
+    markup = params.get("reply_markup") or {}
+    return [
+        button.get("callback_data")
+        for row in markup.get("inline_keyboard", [])
+        for button in row
+    ]
+
+
+def menu_sent(method: str, params: dict) -> bool:
+    return method == "sendMessage" and "PAGE#1" in callbacks(params)
+
+
+def message_edited(method: str, params: dict) -> bool:
+    return method == "editMessageText"
+
+
+def reply_finished(method: str, params: dict) -> bool:
+    return "Start_Again_SAVE" in callbacks(params)
+
+
+def conversation_retrieved(method: str, params: dict) -> bool:
+    return method == "sendMessage" and params.get("text", "").startswith("Conversation")
+
+
+def image_described(method: str, params: dict) -> bool:
+    return (
+        method == "sendMessage"
+        and params.get("text") != PLACEHOLDER
+        and "Start_Again" in callbacks(params)
+    )
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {"p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": values[-1]}
+
+
+def sample_jpeg(width: int = 1280, height: int = 960) -> bytes:
+    buffer = io.BytesIO()
+    PIL.Image.new("RGB", (width, height), (90, 140, 200)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+class VirtualUser:
+    def __init__(self, user_id: int, fake: FakeBotAPI, args, report) -> None:
+        self.user_id = user_id
+        self.fake = fake
+        self.turns = args.turns
+        self.timeout = args.timeout
+        self.report = report
+
+    async def step(self, handler: str, update: dict, answered) -> dict:
+        """Sends an update and waits for the call of the bot that answers it."""
+        start = len(self.fake.calls)
+        started = time.perf_counter()
+        self.fake.push_update(update)
+        try:
+            _, params = await self.fake.wait_for_call(
+                lambda method, params: params.get("chat_id") == self.user_id
+                and answered(method, params),
+                start,
+                self.timeout,
+            )
+        except asyncio.TimeoutError:
+            self.report["failures"][handler] = (
+                self.report["failures"].get(handler, 0) + 1
+            )
+            raise JourneyFailed(handler)
+        self.report["samples"].setdefault(handler, []).append(
+            time.perf_counter() - started
+        )
+        return params
+
+    async def converse(self, journey: int, turns: int) -> None:
+        await self.step(
+            "start_conversation",
+            callback_update(self.user_id, "New_Conversation"),
+            message_edited,
+        )
+        for turn in range(turns):
+            text = (
+                f"Question {turn + 1} of user {self.user_id} in journey {journey}: "
+                f"how does topic {random.randrange(10**6)} work?"
+            )
+            await self.step(
+                "reply_and_new_message",
+                message_update(self.user_id, text),
+                reply_finished,
+            )
+        await self.step(
+            "start_over", callback_update(self.user_id, "Start_Again_SAVE"), menu_sent
+        )
+
+    async def journey(self, journey: int) -> None:
+        await self.converse(journey, self.turns)
+
+        page = await self.step(
+            "get_conversation_history",
+            callback_update(self.user_id, "PAGE#1"),
+            message_edited,
+        )
+        conv_ids = re.findall(r"/(conv[0-9a-f]+)", page.get("text", ""))
+        if not conv_ids:
+            raise JourneyFailed("get_conversation_history")
+        await self.step(
+            "get_conversation_handler",
+            message_update(self.user_id, f"/{conv_ids[0]}"),
+            conversation_retrieved,
+        )
+        await self.step(
+            "start_over", callback_update(self.user_id, "Start_Again"), menu_sent
+        )
+        await self.converse(journey, 1)
+
+        await self.step(
+            "start_image_conversation",
+            callback_update(self.user_id, "Image_Description"),
+            message_edited,
+        )
+        await self.step(
+            "generate_text_from_image",
+            photo_message_update(
+                self.user_id, caption=f"Photo {journey} of user {self.user_id}"
+            ),
+            image_described,
+        )
+        # Photos keep the user in image mode, so go back to the menu.
+        await self.step(
+            "start_over", callback_update(self.user_id, "Start_Again"), menu_sent
+        )
+
+    async def run(self, journeys: int) -> None:
+        try:
+            await self.step("start", message_update(self.user_id, "/start"), menu_sent)
+            for journey in range(journeys):
+                await self.journey(journey)
+                self.report["journeys"] += 1
+        except JourneyFailed as e:
+            logging.warning(f"User {self.user_id} gave up after {e} timed out")
+
+
+async def monitor_lag(samples: list[float]) -> None:
+    """Records how much later than asked the event loop wakes up a sleeping task."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LAG_INTERVAL
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+async def run(args) -> dict:
+    # Imported here because core reads the environment set below on import.
+    os.environ.update(
+        TELEGRAM_BOT_TOKEN=TOKEN,
+        GEMINI_API_TOKEN="load-test",
+        GEMINI_RPM=str(args.gemini_rpm),
+        STREAM_RESPONSES="true" if args.stream else "false",
+    )
+    user_ids = [FIRST_USER_ID + i for i in range(args.users)]
+    os.environ["AUTHORIZED_USER"] = ",".join(str(user_id) for user_id in user_ids)
+
+    from tools.fake_gemini import FakeGemini, Latency
+
+    fake = FakeBotAPI(
+        TOKEN, file_data=sample_jpeg(), latency=Latency.parse(args.telegram_latency)
+    )
+    await fake.start()
+    os.environ["TELEGRAM_API_BASE_URL"] = fake.base_url
+
+    import main
+    from core import model_registry
+    from database.async_database import AsyncDatabase
+
+    logging.getLogger().setLevel(logging.WARNING)
+    gemini = FakeGemini(
+        ttft=Latency.parse(args.gemini_ttft),
+        chunks=args.gemini_chunks,
+        chunk_delay=args.gemini_chunk_delay,
+        reply_chars=args.reply_chars,
+        error_rate=args.gemini_error_rate,
+    )
+    gemini.install(model_registry)
+
+    report = {"journeys": 0, "failures": {}, "samples": {}}
+    lag = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        main.db = AsyncDatabase(os.path.join(tmp_dir, "load_test.db"))
+        application = main.build_application()
+        async with application:
+            await application.post_init(application)
+            await application.updater.start_polling(
+                poll_interval=0, allowed_updates=main.ALLOWED_UPDATES
+            )
+            await application.start()
+
+            lag_task = asyncio.create_task(monitor_lag(lag))
+            started = time.perf_counter()
+            users = [VirtualUser(user_id, fake, args, report) for user_id in user_ids]
+            await asyncio.gather(*(user.run(args.journeys) for user in users))
+            elapsed = time.perf_counter() - started
+            lag_task.cancel()
+
+            await application.updater.stop()
+            await application.stop()
+        await application.post_shutdown(application)
+    await fake.stop()
+
+    samples = report.pop("samples")
+    updates = sum(len(values) for values in samples.values())
+    return {
+        "config": vars(args),
+        "duration": elapsed,
+        "journeys": report["journeys"],
+        "updates": updates,
+        "updates_per_second": updates / elapsed,
+        "failures": report["failures"],
+        "handlers": {
+            handler: {"count": len(values), **percentiles(values)}
+            for handler, values in samples.items()
+        },
+        "event_loop_lag": percentiles(lag),
+        "gemini_requests": gemini.requests,
+        "telegram_calls": len(fake.calls),
+    }
+
+
+def print_report(result: dict) -> None:
+    print(
+        f"{result['journeys']} journeys, {result['updates']} updates in "
+        f"{result['duration']:.1f} s: {result['updates_per_second']:.1f} updates/s"
+    )
+    print(
+        f"Gemini requests: {sum(result['gemini_requests'].values())}, "
+        f"Telegram calls: {result['telegram_calls']}"
+    )
+    print(f"\n{'handler':<26} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for handler, stats in result["handlers"].items():
+        print(
+            f"{handler:<26} {stats['count']:>6} "
+            + " ".join(
+                f"{stats[q] * 1e3:>6.0f} ms" for q in ("p50", "p95", "p99", "max")
+            )
+        )
+    lag = result["event_loop_lag"]
+    if lag:
+        print(
+            f"\nevent loop lag: p50 {lag['p50'] * 1e3:.1f} ms, "
+            f"p99 {lag['p99'] * 1e3:.1f} ms, max {lag['max'] * 1e3:.1f} ms"
+        )
+    for handler, count in result["failures"].items():
+        print(f"FAIL: {count} {handler} updates weren't answered in time")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20, help="concurrent users")
+    parser.add_argument("--journeys", type=int, default=2, help="journeys per user")
+    parser.add_argument("--turns", type=int, default=3, help="messages per chat")
+    parser.add_argument(
+        "--gemini-ttft",
+        default="0.5,1.5",
+        help="Gemini time to first token in seconds: median[,p95]",
+    )
+    parser.add_argument("--gemini-chunks", type=int, default=8)
+    parser.add_argument("--gemini-chunk-delay", type=float, default=0.05)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--gemini-rpm", type=float, default=0, help="Gemini quota, 0 for none"
+    )
+    parser.add_argument("--reply-chars", type=int, default=1200)
+    parser.add_argument(
+        "--telegram-latency",
+        default="0.03,0.1",
+        help="Bot API latency in seconds: median[,p95]",
+    )
+    parser.add_argument(
+        "--no-stream",
+        dest="stream",
+        action="store_false",
+        help="send replies in one message instead of streaming them",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="seconds to wait for an answer"
+    )
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(result, fp, indent=2)
+    raise SystemExit(1 if result["failures"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Converts legacy pickled conversation histories to the history file format.
+
+Run from the project root:  python -m tools.migrate_pickles [--compression none] [--delete]
+Every ./pickles/<conv_id>.pickle is written to ./pickles/<conv_id>.history and
+read back to check it before the pickle is (optionally) deleted. Files that are
+already converted are skipped, so the tool can be run again safely.
+Only run it on pickles written by the bot itself, unpickling runs arbitrary code.
+"""
+
+import os
+import glob
+import pickle
+import argparse
+
+from helpers import history_codec
+
+
+def migrate_file(pickle_path: str, compression: str, delete: bool) -> str:
+    history_path = pickle_path[: -len(".pickle")] + history_codec.FILE_EXTENSION
+    if os.path.exists(history_path):
+        return "skipped"
+
+    with open(pickle_path, "rb") as fp:
+        history = list(pickle.load(fp))
+
+    tmp_path = history_path + ".tmp"
+    history_codec.save_history_file(tmp_path, history, compression)
+    if history_codec.load_history_file(tmp_path) != history:
+        os.remove(tmp_path)
+        raise ValueError("history read back differs from the pickle")
+    os.replace(tmp_path, history_path)
+
+    if delete:
+        os.remove(pickle_path)
+    return "converted"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", default="./pickles")
+    parser.add_argument(
+        "--compression", choices=list(history_codec.COMPRESSIONS), default="gzip"
+    )
+    parser.add_argument(
+        "--delete", action="store_true", help="delete pickles after converting them"
+    )
+    args = parser.parse_args()
+
+    counts = {"converted": 0, "skipped": 0, "failed": 0}
+    for pickle_path in sorted(glob.glob(os.path.join(args.dir, "*.pickle"))):
+        try:
+            result = migrate_file(pickle_path, args.compression, args.delete)
+        except Exception as e:
+            print(f"FAIL {pickle_path}: {e}")
+            result = "failed"
+        counts[result] += 1
+
+    print(", ".join(f"{count} {name}" for name, count in counts.items()))
+    raise SystemExit(1 if counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Check of how SQLitePersistence writes chat histories.
+
+Run from the project root:  python -m tools.persistence_check
+Hands user data to the persistence as deep copies, like Application does on
+every persistence run, and checks which history rows get written: only the new
+turns of a chat, nothing for unchanged data, a rewrite for a replaced chat.
+Gemini isn't called.
+"""
+
+import os
+import copy
+import asyncio
+import sqlite3
+import logging
+import tempfile
+
+import google.ai.generativelanguage as glm
+
+from core import GeminiChat
+from database.async_database import AsyncDatabase
+from bot.persistence import SQLitePersistence
+
+USER_ID = 42
+TOKEN = "gemini-token"
+KEY = "gemini_chat"
+
+LOG_WRITES = """
+CREATE TABLE history_writes (action TEXT NOT NULL, seq INTEGER NOT NULL);
+CREATE TRIGGER log_history_insert AFTER INSERT ON persisted_history
+BEGIN INSERT INTO history_writes VALUES ('insert', NEW.seq); END;
+CREATE TRIGGER log_history_delete AFTER DELETE ON persisted_history
+BEGIN INSERT INTO history_writes VALUES ('delete', OLD.seq); END;
+"""
+
+
+def turns(*texts: str) -> list:
+    return [
+        glm.Content(role="user" if i % 2 == 0 else "model", parts=[glm.Part(text=t)])
+        for i, t in enumerate(texts)
+    ]
+
+
+def history_writes(db_file: str) -> list[tuple[str, int]]:
+    """The history rows written since the last call."""
+    with sqlite3.connect(db_file) as conn:
+        rows = conn.execute("SELECT action, seq FROM history_writes").fetchall()
+        conn.execute("DELETE FROM history_writes")
+    return rows
+
+
+async def run() -> list[str]:
+    failures = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "persistence.db")
+        db = AsyncDatabase(db_file)
+        persistence = SQLitePersistence(db, gemini_token=TOKEN)
+        await persistence.get_user_data()
+        with sqlite3.connect(db_file) as conn:
+            conn.executescript(LOG_WRITES)
+
+        async def persist(data: dict) -> list[tuple[str, int]]:
+            # Application hands over a deep copy of the user data every time.
+            await persistence.update_user_data(USER_ID, copy.deepcopy(data))
+            await persistence.flush()
+            return history_writes(db_file)
+
+        chat = GeminiChat(gemini_token=TOKEN, chat_history=turns("a", "b"))
+        live = {KEY: chat, "lang": "en"}
+
+        writes = await persist(live)
+        if writes != [("insert", 0), ("insert", 1)]:
+            failures.append(f"first write of the chat wrote {writes}")
+
+        chat.chat_history.extend(turns("c", "d"))
+        writes = await persist(live)
+        if writes != [("insert", 2), ("insert", 3)]:
+            failures.append(f"two new turns wrote {writes}, expected only them")
+
+        writes = await persist(live)
+        if writes:
+            failures.append(f"unchanged user data wrote {writes}")
+
+        live[KEY] = GeminiChat(gemini_token=TOKEN, chat_history=turns("e"))
+        writes = await persist(live)
+        if sorted(writes) != [("delete", seq) for seq in range(4)] + [("insert", 0)]:
+            failures.append(f"a replaced chat wrote {writes}, expected a rewrite")
+
+        user_data = await SQLitePersistence(db, gemini_token=TOKEN).get_user_data()
+        loaded = user_data.get(USER_ID, {})
+        if loaded.get("lang") != "en" or not isinstance(loaded.get(KEY), GeminiChat):
+            failures.append(f"loaded user data {loaded}")
+        elif loaded[KEY].chat_history != live[KEY].chat_history:
+            failures.append("loaded chat history differs from the persisted one")
+
+        db.close()
+
+    return failures
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.WARNING)
+    failures = asyncio.run(run())
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("persistence check:", "FAILED" if failures else "OK")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
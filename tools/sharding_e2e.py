@@ -0,0 +1,176 @@
+"""End-to-end check of the multi-process mode against the local fake Bot API.
+
+Run from the project root:  python -m tools.sharding_e2e [--workers 2] [--users 8]
+It starts the fake Bot API, the worker processes and a polling intake, pushes
+updates of several users and checks that every user was answered, that each
+user's updates were handled in order, that each worker got its share of the
+Gemini limits and that the conversation state reached the shared database.
+Gemini isn't called.
+"""
+
+import os
+import json
+import math
+import socket
+import asyncio
+import sqlite3
+import logging
+import argparse
+import tempfile
+import urllib.request
+
+from tools.fake_bot_api import FakeBotAPI, message_update, callback_update
+
+TOKEN = "123456:TEST"
+USER_ID = 42
+GEMINI_RPM = 60
+GEMINI_MAX_CONCURRENCY = 16
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Set before main is imported, as it reads them on import. Like main.py, this
+# module is imported again by each spawned worker, which has to get its own
+# settings from the environment it was started with.
+if __name__ == "__main__":
+    os.environ.update(
+        AUTHORIZED_USER=str(USER_ID),
+        PERSISTENCE_INTERVAL="0.5",
+        GEMINI_RPM=str(GEMINI_RPM),
+        GEMINI_MAX_CONCURRENCY=str(GEMINI_MAX_CONCURRENCY),
+        METRICS_PORT=str(free_port()),
+    )
+
+import main as bot_main
+from bot.sharding import ShardedWorkers, shard_of
+
+
+async def wait_for(condition, timeout: float = 30) -> bool:
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+def scrape(port: int) -> dict[str, float]:
+    """The unlabelled samples of a metrics endpoint."""
+    url = f"http://127.0.0.1:{port}/metrics"
+    with urllib.request.urlopen(url, timeout=5) as response:
+        text = response.read().decode()
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#") and "{" not in line:
+            name, value = line.split()
+            samples[name] = float(value)
+    return samples
+
+
+async def run(workers_count: int, users: int) -> list[str]:
+    fake = FakeBotAPI(TOKEN)
+    await fake.start()
+
+    metrics_port = int(os.environ["METRICS_PORT"])
+    os.environ.update(
+        TELEGRAM_BOT_TOKEN=TOKEN,
+        TELEGRAM_API_BASE_URL=fake.base_url,
+    )
+
+    failures = []
+    user_ids = [USER_ID + i for i in range(users)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "sharding.db")
+        workers = ShardedWorkers(workers_count, db_file)
+        workers.start()
+        application = bot_main.build_intake_application(workers)
+
+        async with application:
+            await application.updater.start_polling(
+                poll_interval=0, allowed_updates=bot_main.ALLOWED_UPDATES
+            )
+            await application.start()
+
+            for user_id in user_ids:
+                fake.push_update(message_update(user_id, "/start"))
+            # Only handled after /start moved the conversation to its menu state.
+            fake.push_update(callback_update(USER_ID, "New_Conversation"))
+
+            def answered() -> set:
+                calls = fake.calls_of("sendMessage") + fake.calls_of("sendAnimation")
+                return {call["chat_id"] for call in calls}
+
+            if not await wait_for(lambda: answered() >= set(user_ids)):
+                missing = sorted(set(user_ids) - answered())
+                failures.append(f"users {missing} weren't answered")
+            if not await wait_for(lambda: fake.calls_of("editMessageText")):
+                failures.append("callback after /start wasn't handled in order")
+
+            expected_limits = {
+                "gemini_scheduler_requests_per_minute": math.ceil(
+                    GEMINI_RPM / workers_count
+                ),
+                "gemini_scheduler_max_concurrency": math.ceil(
+                    GEMINI_MAX_CONCURRENCY / workers_count
+                ),
+            }
+            for index in range(workers_count):
+                try:
+                    samples = await asyncio.to_thread(scrape, metrics_port + index + 1)
+                except OSError as e:
+                    failures.append(f"metrics of worker {index} unavailable: {e}")
+                    continue
+                limits = {name: samples.get(name) for name in expected_limits}
+                if limits != expected_limits:
+                    failures.append(
+                        f"worker {index} has limits {limits}, expected {expected_limits}"
+                    )
+
+            await application.updater.stop()
+            await application.stop()
+
+        expected = [0] * workers_count
+        for user_id in user_ids:
+            expected[shard_of(user_id, workers_count)] += 1
+        expected[shard_of(USER_ID, workers_count)] += 1
+        if workers.forwarded != expected:
+            failures.append(f"forwarded {workers.forwarded}, expected {expected}")
+
+        # Workers flush their persistence when they stop.
+        await asyncio.to_thread(workers.stop)
+        if any(process.exitcode != 0 for process in workers.processes):
+            codes = [process.exitcode for process in workers.processes]
+            failures.append(f"workers exited with {codes}")
+
+        with sqlite3.connect(db_file) as conn:
+            rows = conn.execute(
+                "SELECT key FROM persisted_conversation_states WHERE name = ?",
+                ("conversation",),
+            ).fetchall()
+        if [USER_ID, USER_ID] not in [json.loads(key) for key, in rows]:
+            failures.append("conversation state wasn't persisted to the database")
+
+    await fake.stop()
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--users", type=int, default=8)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    failures = asyncio.run(run(args.workers, args.users))
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("sharding e2e:", "FAILED" if failures else "OK")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
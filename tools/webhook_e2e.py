@@ -0,0 +1,110 @@
+"""End-to-end check of webhook mode against the local fake Bot API.
+
+Run from the project root:  python -m tools.webhook_e2e
+It starts the fake Bot API and the bot in webhook mode, posts updates to the
+webhook like Telegram does and checks what the bot did. Gemini isn't called.
+"""
+
+import os
+import socket
+import asyncio
+import logging
+import tempfile
+
+import httpx
+
+from tools.fake_bot_api import FakeBotAPI, message_update
+
+TOKEN = "123456:TEST"
+SECRET = "webhook-secret"
+USER_ID = 42
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run() -> list[str]:
+    fake = FakeBotAPI(TOKEN)
+    await fake.start()
+
+    os.environ.update(
+        TELEGRAM_BOT_TOKEN=TOKEN,
+        TELEGRAM_API_BASE_URL=fake.base_url,
+        AUTHORIZED_USER=str(USER_ID),
+    )
+    import main
+    from database.async_database import AsyncDatabase
+    from bot.webhook import serve_webhook
+
+    port = free_port()
+    webhook = f"http://127.0.0.1:{port}/telegram"
+    failures = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        main.db = AsyncDatabase(os.path.join(tmp_dir, "e2e.db"))
+        stop_event = asyncio.Event()
+        serving = asyncio.create_task(
+            serve_webhook(
+                main.build_application(),
+                webhook_url=webhook,
+                listen="127.0.0.1",
+                port=port,
+                url_path="/telegram",
+                secret_token=SECRET,
+                allowed_updates=main.ALLOWED_UPDATES,
+                stop_event=stop_event,
+            )
+        )
+        while not fake.calls_of("setWebhook"):
+            await asyncio.sleep(0.05)
+
+        set_webhook = fake.calls_of("setWebhook")[0]
+        if set_webhook.get("allowed_updates") != ["message", "callback_query"]:
+            failures.append(f"unexpected allowed_updates {set_webhook}")
+        if set_webhook.get("secret_token") != SECRET:
+            failures.append("secret token wasn't registered")
+
+        async with httpx.AsyncClient() as client:
+            update = {"update_id": 1, **message_update(USER_ID, "/start")}
+            response = await client.post(
+                webhook, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "x"}
+            )
+            if response.status_code != 403:
+                failures.append(f"wrong secret answered {response.status_code}")
+
+            response = await client.post(
+                webhook,
+                json=update,
+                headers={"X-Telegram-Bot-Api-Secret-Token": SECRET},
+            )
+            if response.status_code != 200:
+                failures.append(f"valid update answered {response.status_code}")
+
+        for _ in range(50):
+            if fake.calls_of("sendMessage"):
+                break
+            await asyncio.sleep(0.05)
+        else:
+            failures.append("bot didn't reply to /start")
+
+        stop_event.set()
+        await serving
+
+    await fake.stop()
+    return failures
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.WARNING)
+    failures = asyncio.run(run())
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("webhook e2e:", "FAILED" if failures else "OK")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()